@@ -1,31 +1,63 @@
+import array
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import math
+import mmap
+import operator
+import os
+import pickle
+import struct
+import sys
+import tempfile
 import typing
 
 
 class Handle:
-    def __init__(self, ref):
+    def __init__(self, ref, engine: typing.Optional['Engine'] = None):
         self.ref_ = ref
+        self.engine_ = default_engine if engine is None else engine
+        self.store_ = self.engine_.store
+        self.store_.retain(ref)
+
+    def __del__(self):
+        self.store_.release(self.ref_)
 
     def value(self):
-        return global_store.value(self.ref_)
+        return self.engine_.store.value(self.ref_)
 
     def car(self):
-        return Handle(global_store.car(self.ref_))
+        return Handle(self.engine_.store.car(self.ref_), self.engine_)
 
     def cdr(self):
-        return Handle(global_store.cdr(self.ref_))
+        return Handle(self.engine_.store.cdr(self.ref_), self.engine_)
 
     def pair(self, other):
         """should be #,"""
-        return Handle(global_store.make_pair(self.ref_, other.ref_))
+        self.check_engine(other)
+        return Handle(self.engine_.store.make_pair(self.ref_, other.ref_), self.engine_)
 
     def make_const(self, value):
-        return self.pair(C.make_const(value))
+        return self.pair(self.engine_.C.make_const(value))
 
     def make_variable(self, name):
-        return self.pair(V.make_variable(name))
+        return self.pair(self.engine_.V.make_variable(name))
 
     def go(self, handle2: 'Handle', do):
-        global_store.unify(self.ref_, handle2.ref_, do)
+        self.check_engine(handle2)
+        self.engine_.store.unify(self.ref_, handle2.ref_, do)
+
+    def unify(self, handle2: 'Handle', occurs_check=True) -> bool:
+        self.check_engine(handle2)
+        store = self.engine_.store
+        return store.unify_values(store.get_item_or_ref(self.ref_),
+                                  store.get_item_or_ref(handle2.ref_), occurs_check)
+
+    def check_engine(self, other: 'Handle'):
+        """Refs only mean something in the store of their engine."""
+        if other.engine_ is not self.engine_:
+            raise Exception("{} was made through another engine".format(other))
 
     def __eq__(self, other):
         return self.ref_ == other.ref_
@@ -37,87 +69,199 @@ class Handle:
         return HandleConjunction.from_handle(self)
 
     def __repr__(self):
-        return "Handle({} => {})".format(self.ref_, global_store.get_item_or_ref(self.ref_))
+        return "Handle({} => {})".format(self.ref_, self.engine_.store.get_item_or_ref(self.ref_))
 
     def get_free_variables(self):
-        return global_store.get_free_vars(self.ref_)
+        return self.engine_.store.get_free_vars(self.ref_)
 
     def substitute(self, subst):
-        return Handle(global_store.substitute_ref(self.ref_, subst))
+        ref = self.engine_.store.substitute_ref(self.ref_, subst)
+        if ref == self.ref_:
+            return self
+        return Handle(ref, self.engine_)
+
+    def index_key(self):
+        return self.engine_.store.index_key(self.ref_)
+
+    def could_match(self, other: 'Handle') -> bool:
+        return self.engine_.store.could_match(self.ref_, other.ref_)
 
 
 class HandleConjunction:
-    def __init__(self, handles: typing.List[Handle]):
-        self.handles: typing.List[Handle] = handles
+    """A persistent linked list of goals, (handle, rest) pairs ending in None.
+
+    tail() shares the rest of the list and substitute() shares the suffix in
+    which no goal changed."""
+
+    def __init__(self, handles: typing.Iterable[Handle] = ()):
+        self.goals = HandleConjunction.chain(handles, None)
+
+    @staticmethod
+    def chain(handles: typing.Iterable[Handle], rest):
+        for handle in reversed(list(handles)):
+            rest = (handle, rest)
+        return rest
+
+    @staticmethod
+    def link(goals) -> 'HandleConjunction':
+        con = HandleConjunction()
+        con.goals = goals
+        return con
 
     @staticmethod
     def from_handle(handle) -> 'HandleConjunction':
-        return HandleConjunction([handle])
+        return HandleConjunction.link((handle, None))
 
     def __and__(self, other: typing.Union[Handle, 'HandleConjunction']) ->\
             'HandleConjunction':
-        con = other.to_conjunction()
-        return HandleConjunction(self.handles + con.handles)
+        """Joins lazily, so chaining & stays linear; the goals are linked on
+        first use."""
+        con = HandleConjunction.__new__(HandleConjunction)
+        con.pending = self, other.to_conjunction()
+        return con
+
+    def __getattr__(self, name):
+        if name != 'goals':
+            raise AttributeError(name)
+        rights = []
+        con = self
+        while 'goals' not in vars(con):
+            con, right = con.pending
+            rights.append(right)
+        handles = list(con)
+        for right in reversed(rights[1:]):
+            handles.extend(right)
+        self.goals = HandleConjunction.chain(handles, rights[0].goals)
+        del self.pending
+        return self.goals
+
+    def prepend(self, rest):
+        """The goals of this conjunction followed by the linked list rest."""
+        if rest is None:
+            return self.goals
+        return HandleConjunction.chain(self, rest)
 
     def to_conjunction(self) -> 'HandleConjunction':
         return self
 
     def empty(self) -> bool:
-        return not self.handles
+        return self.goals is None
 
     def head(self) -> Handle:
-        return self.handles[0]
+        return self.goals[0]
 
     def tail(self) -> 'HandleConjunction':
-        return HandleConjunction(self.handles[1:])
+        return HandleConjunction.link(self.goals[1])
+
+    def __iter__(self) -> typing.Iterator[Handle]:
+        goals = self.goals
+        while goals is not None:
+            handle, goals = goals
+            yield handle
+
+    @property
+    def handles(self) -> typing.List[Handle]:
+        return list(self)
 
     def __repr__(self):
         return "HandleConjunction([{}])".format(
-            ", ".join(str(handle) for handle in self.handles))
+            ", ".join(str(handle) for handle in self))
 
     def get_free_variables(self):
         return [item
-                for handle in self.handles
+                for handle in self
                 for item in handle.get_free_variables()]
 
     def substitute(self, subst):
-        return HandleConjunction([handle.substitute(subst) for handle in self.handles])
+        nodes = []
+        substituted = []
+        goals = self.goals
+        last_changed = -1
+        while goals is not None:
+            nodes.append(goals)
+            handle, goals = goals
+            substituted.append(handle.substitute(subst))
+            if substituted[-1] is not handle:
+                last_changed = len(nodes) - 1
+        goals = nodes[last_changed + 1] if last_changed + 1 < len(nodes) else None
+        for handle in reversed(substituted[:last_changed + 1]):
+            goals = (handle, goals)
+        return HandleConjunction.link(goals)
+
+
+class Constants:
+    def __init__(self, engine: 'Engine'):
+        self.engine = engine
 
+    def make_const(self, value):
+        return Handle(self.engine.store.make_const(value), self.engine)
 
-class C:
-    @staticmethod
-    def make_const(value):
-        return Handle(global_store.make_const(value))
 
+class Variables:
+    def __init__(self, engine: 'Engine'):
+        self.engine = engine
 
-class V:
-    @staticmethod
-    def make_variable(name):
-        return Handle(global_store.make_variable(name))
+    def make_variable(self, name):
+        return Handle(self.engine.store.make_variable(name), self.engine)
+
+
+class Engine:
+    """A store with the constructors bound to it. Terms and programs made
+    through different engines share nothing, so each engine can serve its
+    own thread; one engine runs one search at a time."""
+
+    def __init__(self, store: typing.Optional['Store'] = None):
+        self.store = Store() if store is None else store
+        self.C = Constants(self)
+        self.V = Variables(self)
+        self.L = Handle(self.store.nil, self)
+
+    def prolog(self, **options) -> 'Prolog':
+        return Prolog(engine=self, **options)
 
 
 class NextRef:
     def __init__(self, value):
         self.value = value
 
-    def get(self):
+    def get(self, count=1):
         value = self.value
-        self.value += 1
+        self.value += count
         return value
 
-    def clone(self):
-        return NextRef(self.value)
-
 
 class Store:
-    def __init__(self):
-        self.items: typing.Dict[typing.Any, Value] = {}
-        self.variables = {}
+    def __init__(self, hash_consing=False, gc_threshold=None):
         self.next_ref = NextRef(0)
+        self.items: typing.MutableMapping[typing.Any, Value] = self.empty_items()
+        self.variables = {}
+        self.ranks: typing.Dict[typing.Any, int] = {}
+        self.trail: typing.List[typing.Tuple[dict, typing.Any, typing.Any]] = []
+        self.boundary = math.inf
+        self.depth = 0
+        self.hash_consing = hash_consing
+        self.interned: typing.Dict[typing.Any, Value] = {}
+        self.handles: typing.Dict[typing.Any, int] = {}
+        self.floor = 0
+        self.gc_threshold = gc_threshold
+        self.collected_at = 0
+        self.searches: typing.List[typing.Tuple[int, typing.Callable[[], typing.Iterable[Value]]]] = []
+        self.nil = self.make_const(None)
+
+    def empty_items(self) -> typing.MutableMapping[typing.Any, 'Value']:
+        return {}
+
+    def intern(self, value: 'Value') -> 'Value':
+        if not self.hash_consing or not value.ground:
+            return value
+        key = value.intern_key()
+        if key is None:
+            return value
+        return self.interned.setdefault(key, value)
 
     def make_const(self, val):
         ref = self.next_ref.get()
-        self.items[ref] = ConstValue(val)
+        self.items[ref] = self.intern(ConstValue(val))
         return ref
 
     def make_variable(self, name):
@@ -127,24 +271,66 @@ class Store:
 
     def make_pair(self, ref1, ref2):
         ref = self.next_ref.get()
-        self.items[ref] = PairValue(self.get_item_or_ref(ref1),
-                                    self.get_item_or_ref(ref2))
+        self.items[ref] = self.intern(PairValue(self.get_item_or_ref(ref1),
+                                                self.get_item_or_ref(ref2)))
         return ref
 
     def get_item_or_ref(self, ref):
         try:
-            return self.items[ref]
+            value = self.items[ref]
         except KeyError:
             return RefValue(ref)
+        return self.find(ref, value)
 
     def get_item(self, ref):
         try:
-            return self.items[ref]
+            value = self.items[ref]
         except KeyError:
             raise Exception("Value not set")
+        return self.find(ref, value)
 
     def value(self, ref):
-        return self.get_item(ref).value()
+        return self.python_value(self.get_item(ref))
+
+    def python_value(self, value: 'Value', unbound: typing.Optional[typing.Callable] = None):
+        stack = [(value, False)]
+        results = []
+        while stack:
+            value, built = stack.pop()
+            if built:
+                value2 = results.pop()
+                results[-1] = (results[-1], value2)
+                continue
+            value = self.deref(value)
+            if isinstance(value, PairValue):
+                stack.append((value, True))
+                stack.append((value.cdr(), False))
+                stack.append((value.car(), False))
+            elif unbound is not None and isinstance(value, RefValue):
+                results.append(unbound(value.ref))
+            else:
+                results.append(value.value())
+        return results[0]
+
+    def from_python(self, item) -> 'Value':
+        """The value python_value, with Unbound for unbound variables, gives
+        item for; 2-tuples are pairs."""
+        stack = [(item, False)]
+        results = []
+        while stack:
+            item, built = stack.pop()
+            if built:
+                value2 = results.pop()
+                results[-1] = self.intern(PairValue(results[-1], value2))
+            elif isinstance(item, Unbound):
+                results.append(RefValue(item.ref))
+            elif isinstance(item, tuple) and len(item) == 2:
+                stack.append((item, True))
+                stack.append((item[1], False))
+                stack.append((item[0], False))
+            else:
+                results.append(self.intern(ConstValue(item)))
+        return results[0]
 
     def car(self, ref):
         res = self.next_ref.get()
@@ -156,56 +342,198 @@ class Store:
         self.items[res] = self.get_item(ref).cdr()
         return res
 
-    def clone(self) -> 'Store':
-        new_store = Store()
-        new_store.items = {k: v.clone() for k, v in self.items.items()}
-        new_store.variables = self.variables.copy()
-        new_store.next_ref = self.next_ref.clone()
-        return new_store
+    def mark(self):
+        return len(self.trail)
 
-    def substitute(self, name, value: 'Value'):
-        new_items = {}
-        for left, right in self.items.items():
-            new_items[left] = right.substitute(name, value)
-        new_items[name] = value
-
-        self.items = new_items
+    def undo(self, mark):
+        while len(self.trail) > mark:
+            table, key, previous = self.trail.pop()
+            if previous is None:
+                del table[key]
+            else:
+                table[key] = previous
+
+    def assign(self, table, key, value):
+        if key < self.boundary:
+            self.trail.append((table, key, table.get(key)))
+        table[key] = value
+
+    def push_choice(self):
+        if self.boundary == math.inf:
+            self.floor = self.next_ref.value
+        point = (self.mark(), self.boundary, self.depth)
+        self.boundary = self.next_ref.value
+        self.depth += 1
+        return point
+
+    def pop_choice(self, point):
+        """Backtracks to point, unless a choice pushed before it was popped
+        already, which undid it too."""
+        mark, boundary, depth = point
+        if depth >= self.depth:
+            return
+        self.boundary = boundary
+        self.depth = depth
+        self.undo(mark)
+
+    def rename(self, value: 'Value', subst: typing.Dict[typing.Any, typing.Any]) -> 'Value':
+        def rename_leaf(leaf):
+            if isinstance(leaf, RefValue) and leaf.ref in subst:
+                return RefValue(subst[leaf.ref])
+            return leaf
+
+        return self.map_leaves(value, rename_leaf)
+
+    def map_leaves(self, value: 'Value', leaf: typing.Callable[['Value'], 'Value']) -> 'Value':
+        stack = [(value, False)]
+        results = []
+        while stack:
+            value, built = stack.pop()
+            if built:
+                value, car, cdr = value
+                value2 = results.pop()
+                value1 = results.pop()
+                if value1 is car and value2 is cdr:
+                    results.append(value)
+                else:
+                    results.append(PairValue(value1, value2))
+                continue
+            value = self.deref(value)
+            if value.ground:
+                results.append(value)
+            elif isinstance(value, PairValue):
+                car = value.car()
+                cdr = value.cdr()
+                stack.append(((value, car, cdr), True))
+                stack.append((cdr, False))
+                stack.append((car, False))
+            else:
+                results.append(leaf(value))
+        return results[0]
 
-    def substitute_list(self, subst_list):
-        for (name, value) in subst_list:
-            self.substitute(name, value)
+    def deref(self, value: 'Value') -> 'Value':
+        return value.deref(self)
 
-    def unify(self, ref1, ref2, do):
-        subst = self.get_item_or_ref(ref1).unify(self.get_item_or_ref(ref2))
+    def find(self, ref, value: 'Value') -> 'Value':
+        if not isinstance(value, RefValue):
+            return value
+        path = [ref]
+        while isinstance(value, RefValue):
+            next_value = self.items.get(value.ref)
+            if next_value is None:
+                break
+            path.append(value.ref)
+            value = next_value
+        for ref in path[:-1]:
+            self.assign(self.items, ref, value)
+        return value
 
-        if subst is None:
-            pass
+    def union(self, ref1, ref2):
+        rank1 = self.ranks.get(ref1, 0)
+        rank2 = self.ranks.get(ref2, 0)
+        if rank1 > rank2:
+            self.assign(self.items, ref2, RefValue(ref1))
         else:
-            if not subst:
-                do()
-            else:
-                new_global_store = self.clone()
-                new_global_store.substitute_list(subst)
-
-                def new_do():
-                    global_store.unify(ref1, ref2, do)
-
-                self.push_store(new_global_store, new_do)
+            self.assign(self.items, ref1, RefValue(ref2))
+            if rank1 == rank2:
+                self.assign(self.ranks, ref2, rank2 + 1)
+
+    def occurs(self, ref, value: 'Value') -> bool:
+        stack = [value]
+        while stack:
+            value = self.deref(stack.pop())
+            if value.ground:
+                continue
+            if isinstance(value, PairValue):
+                stack.append(value.cdr())
+                stack.append(value.car())
+            elif value.has_occurrence(ref):
+                return True
+        return False
 
-    def push_store(self, new_store, do):
-        global global_store
-        global_store = new_store
+    def bind(self, ref, value: 'Value') -> bool:
+        value = self.deref(value)
+        if isinstance(value, RefValue):
+            if value.ref != ref:
+                self.union(ref, value.ref)
+            return True
+        if self.occurs(ref, value):
+            return False
+        self.assign(self.items, ref, value)
+        return True
+
+    def linearize(self, ref):
+        """A copy of the term at ref in which each occurrence of a variable after
+        the first is a fresh variable, and the (variable, fresh variable) pairs."""
+        seen = set()
+        repeats = []
+
+        def rename_repeat(leaf):
+            if isinstance(leaf, RefValue):
+                if leaf.ref in seen:
+                    repeats.append((leaf.ref, self.next_ref.get()))
+                    return RefValue(repeats[-1][1])
+                seen.add(leaf.ref)
+            return leaf
+
+        value = self.map_leaves(self.get_item_or_ref(ref), rename_repeat)
+        if isinstance(value, RefValue):
+            return value.ref, repeats
+        new_ref = self.next_ref.get()
+        self.items[new_ref] = value
+        return new_ref, repeats
+
+    def unify_values(self, value1: 'Value', value2: 'Value', occurs_check=True) -> bool:
+        """Binds variables in place while walking both terms, descending into
+        cars and keeping the pending cdrs on a stack. If the terms do not unify
+        the trailed bindings made so far are undone; the others are to refs made
+        since the last choice point, which backtracking discards anyway.
+
+        Without occurs_check a variable may be bound to a term containing it,
+        so callers only skip it where that cannot happen."""
+        mark = len(self.trail)
+        stack = []
+        while True:
+            if isinstance(value1, RefValue):
+                value1 = value1.deref(self)
+            if isinstance(value2, RefValue):
+                value2 = value2.deref(self)
+            if value1 is not value2:
+                if isinstance(value2, RefValue) and not isinstance(value1, RefValue):
+                    value1, value2 = value2, value1
+                if isinstance(value1, RefValue):
+                    if isinstance(value2, RefValue):
+                        if value1.ref != value2.ref:
+                            self.union(value1.ref, value2.ref)
+                    elif not occurs_check or value2.ground or not self.occurs(value1.ref, value2):
+                        self.assign(self.items, value1.ref, value2)
+                    else:
+                        self.undo(mark)
+                        return False
+                elif isinstance(value1, PairValue):
+                    if not isinstance(value2, PairValue):
+                        self.undo(mark)
+                        return False
+                    stack.append(value1.cdr())
+                    stack.append(value2.cdr())
+                    value1 = value1.car()
+                    value2 = value2.car()
+                    continue
+                elif not value1.same(value2):
+                    self.undo(mark)
+                    return False
+            if not stack:
+                return True
+            value2 = stack.pop()
+            value1 = stack.pop()
 
-        exc = None
+    def unify(self, ref1, ref2, do):
+        point = self.push_choice()
         try:
-            do()
-        except Exception as e:
-            exc = e
-
-        global_store = self
-
-        if exc is not None:
-            raise exc
+            if self.unify_values(self.get_item_or_ref(ref1), self.get_item_or_ref(ref2)):
+                do()
+        finally:
+            self.pop_choice(point)
 
     def __repr__(self):
         return "items: {}; vars: {}".format(
@@ -214,7 +542,18 @@ class Store:
         )
 
     def get_free_vars(self, ref):
-        return self.get_item_or_ref(ref).get_free_vars()
+        stack = [self.get_item_or_ref(ref)]
+        free_vars = []
+        while stack:
+            value = self.deref(stack.pop())
+            if value.ground:
+                continue
+            if isinstance(value, PairValue):
+                stack.append(value.cdr())
+                stack.append(value.car())
+            else:
+                free_vars.extend(value.get_free_vars())
+        return free_vars
 
     def clone_variables(self, vars_list):
         vars_list = list(set(vars_list))
@@ -224,8 +563,11 @@ class Store:
         value = self.items.get(ref)
 
         if value is not None:
+            new_value = self.rename(value, dict(subst_list))
+            if new_value is value:
+                return ref
             new_ref = self.next_ref.get()
-            self.items[new_ref] = value.substitute_ref_list(subst_list)
+            self.items[new_ref] = new_value
             return new_ref
         else:
             for (sub_ref, sub_val) in subst_list:
@@ -233,11 +575,234 @@ class Store:
                     return sub_val
             return ref
 
+    def index_key(self, ref):
+        return self.value_index_key(self.get_item_or_ref(ref))
+
+    def value_index_key(self, value: 'Value'):
+        value = self.deref(value)
+        if isinstance(value, PairValue):
+            primary = (value.functor(), self.deref(value.cdr()).functor())
+            if primary[1] is None:
+                primary = None
+            first = self.deref(value.car())
+            depth = 0
+            while isinstance(first, PairValue) and depth < INDEX_DEPTH:
+                first = self.deref(first.car())
+                depth += 1
+            return primary, (depth, first.functor())
+        return value.functor(), None
+
+    def arguments(self, goal: 'Value', arity: int) -> typing.Optional[typing.List['Value']]:
+        """The dereferenced arguments of a goal with arity arguments before its
+        tag; None where a variable stands for some of them, [] if the goal has
+        another shape."""
+        goal = self.deref(goal)
+        if not isinstance(goal, PairValue):
+            return None if arity == 0 else []
+        node = self.deref(goal.car())
+        arguments = []
+        for _ in range(arity - 1):
+            if isinstance(node, RefValue):
+                return None
+            if not isinstance(node, PairValue):
+                return []
+            arguments.append(self.deref(node.cdr()))
+            node = self.deref(node.car())
+        arguments.append(node)
+        arguments.reverse()
+        return arguments
+
+    def goal_tag(self, value: 'Value'):
+        value = self.deref(value)
+        if isinstance(value, PairValue):
+            value = self.deref(value.cdr())
+        return value.functor()
+
+    def export(self, value: 'Value', numbers: typing.Optional[typing.Dict[typing.Any, int]] = None):
+        """A hashable copy of value with variables numbered by first occurrence,
+        so that variants export equal; constants keep their type, as 1, 1.0
+        and True are equal keys."""
+        if numbers is None:
+            numbers = {}
+        stack = [(value, False)]
+        results = []
+        while stack:
+            value, built = stack.pop()
+            if built:
+                cdr = results.pop()
+                results[-1] = ('pair', results[-1], cdr)
+                continue
+            value = self.deref(value)
+            if isinstance(value, PairValue):
+                stack.append((value, True))
+                stack.append((value.cdr(), False))
+                stack.append((value.car(), False))
+            elif isinstance(value, RefValue):
+                results.append(('var', numbers.setdefault(value.ref, len(numbers))))
+            else:
+                results.append(('const', value.value(), type(value.val)))
+        return results[0]
+
+    def build(self, term, refs: typing.Optional[typing.Dict[int, typing.Any]] = None) -> 'Value':
+        if refs is None:
+            refs = {}
+        stack = [(term, False)]
+        results = []
+        while stack:
+            term, built = stack.pop()
+            if built:
+                cdr = results.pop()
+                results[-1] = self.intern(PairValue(results[-1], cdr))
+            elif term[0] == 'pair':
+                stack.append((term, True))
+                stack.append((term[2], False))
+                stack.append((term[1], False))
+            elif term[0] == 'var':
+                if term[1] not in refs:
+                    refs[term[1]] = self.next_ref.get()
+                results.append(RefValue(refs[term[1]]))
+            else:
+                results.append(self.intern(ConstValue(term[1])))
+        return results[0]
 
-global_store = Store()
+    def make_term(self, term, refs: typing.Optional[typing.Dict[int, typing.Any]] = None):
+        value = self.build(term, refs)
+        if isinstance(value, RefValue):
+            return value.ref
+        ref = self.next_ref.get()
+        self.items[ref] = value
+        return ref
+
+    def could_match(self, ref1, ref2) -> bool:
+        stack = [(self.get_item_or_ref(ref1), self.get_item_or_ref(ref2))]
+        while stack:
+            value1, value2 = stack.pop()
+            value1 = self.deref(value1)
+            value2 = self.deref(value2)
+            if isinstance(value1, RefValue) or isinstance(value2, RefValue):
+                continue
+            if isinstance(value1, PairValue) and isinstance(value2, PairValue):
+                stack.append((value1.cdr(), value2.cdr()))
+                stack.append((value1.car(), value2.car()))
+            elif not isinstance(value1, PairValue) and not value1.same(value2):
+                return False
+        return True
+
+    def retain(self, ref):
+        self.handles[ref] = self.handles.get(ref, 0) + 1
+
+    def release(self, ref):
+        count = self.handles[ref] - 1
+        if count:
+            self.handles[ref] = count
+        else:
+            del self.handles[ref]
+
+    def enter_search(self, held: typing.Callable[[], typing.Iterable['Value']]):
+        """Registers a running search, which keeps the values held gives
+        besides handles; returns what leave_search takes."""
+        search = self.next_ref.value, held
+        self.searches.append(search)
+        return search
+
+    def leave_search(self, search):
+        self.searches.remove(search)
+
+    def roots(self):
+        """Refs held by live handles (clauses of every Prolog included), named
+        variables and the trail. While a search runs, those of the values it
+        holds, plus everything allocated since the outermost active choice
+        point before it started, as suspended searches and the code that ran
+        them keep bare values around; without one, everything allocated since
+        that choice point."""
+        yield self.nil
+        yield from self.handles
+        yield from self.variables.values()
+        for table, key, previous in self.trail:
+            if table is self.items:
+                yield key
+                if previous is not None:
+                    yield from self.value_refs(previous)
+        if self.searches:
+            start, held = self.searches[-1]
+            yield from (ref for ref in self.items if self.floor <= ref < start)
+            for value in held():
+                if value is not None:
+                    yield from self.value_refs(value)
+        elif self.boundary != math.inf:
+            yield from (ref for ref in self.items if ref >= self.floor)
+
+    def value_refs(self, value: 'Value'):
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, PairCell):
+                yield value.address
+                yield value.address + 1
+            elif value.ground:
+                continue
+            elif isinstance(value, PairValue):
+                stack.append(value.cdr())
+                stack.append(value.car())
+            else:
+                yield from value.get_free_vars()
+
+    def collect(self, roots: typing.Iterable[typing.Any] = ()):
+        live = set()
+        stack = list(self.roots())
+        stack.extend(roots)
+        while stack:
+            ref = stack.pop()
+            if ref in live:
+                continue
+            live.add(ref)
+            value = self.items.get(ref)
+            if value is not None:
+                stack.extend(self.value_refs(value))
+        self.sweep(live)
+        self.collected_at = self.next_ref.value
+
+    def sweep(self, live):
+        for ref in [ref for ref in self.items if ref not in live]:
+            del self.items[ref]
+        for ref in [ref for ref in self.ranks if ref not in live]:
+            del self.ranks[ref]
+        self.sweep_interned()
+
+    def sweep_interned(self):
+        """Forgets interned values no item or trail entry holds any more."""
+        if not self.interned:
+            return
+        reachable = set()
+        stack = list(self.items.values())
+        stack.extend(previous for table, _, previous in self.trail
+                     if table is self.items and previous is not None)
+        while stack:
+            value = stack.pop()
+            if id(value) in reachable or isinstance(value, (RefValue, PairCell)):
+                continue
+            reachable.add(id(value))
+            if isinstance(value, PairValue):
+                stack.append(value.value2)
+                stack.append(value.value1)
+        self.interned = {key: value for key, value in self.interned.items() if id(value) in reachable or
+                         isinstance(value, PairCell) and value.address in self.items}
+
+    def maybe_collect(self):
+        if self.gc_threshold is not None and \
+                self.next_ref.value - self.collected_at >= self.gc_threshold:
+            self.collect()
+
+
+INDEX_DEPTH = 8
+IMAGE_MAGIC = b'PLIMAGE1'
 
 
 class Value:
+    __slots__ = ()
+
+    ground = False
+
     def car(self):
         raise NotImplementedError()
 
@@ -247,41 +812,30 @@ class Value:
     def value(self):
         raise NotImplementedError()
 
-    def clone(self) -> 'Value':
-        raise NotImplementedError()
-
-    def substitute(self, ref, value: 'Value') -> 'Value':
-        raise NotImplementedError()
-
-    def unify(self, other):
-        raise NotImplementedError()
+    def deref(self, store: 'Store') -> 'Value':
+        return self
 
-    def unify_with_const(self, const_value):
+    def same(self, other: 'Value') -> bool:
         raise NotImplementedError()
 
-    def unify_with_var(self, ref):
+    def has_occurrence(self, ref):
         raise NotImplementedError()
 
-    def unify_with_pair(self, a: 'Value', b: 'Value'):
+    def functor(self):
         raise NotImplementedError()
 
-    def has_occurrence(self, ref):
+    def intern_key(self):
         raise NotImplementedError()
 
     def get_free_vars(self):
         raise NotImplementedError()
 
-    def substitute_ref(self, old_ref, new_ref) -> 'Value':
-        raise NotImplementedError()
 
-    def substitute_ref_list(self, subst_list):
-        new_val = self
-        for ref, new_ref in subst_list:
-            new_val = new_val.substitute_ref(ref, new_ref)
-        return new_val
+class ConstValue(Value):
+    __slots__ = ('val',)
 
+    ground = True
 
-class ConstValue(Value):
     def __init__(self, val):
         self.val = val
 
@@ -294,45 +848,39 @@ class ConstValue(Value):
     def value(self):
         return self.val
 
-    def clone(self):
-        return self
-
-    def substitute(self, ref, value: Value):
-        return self
-
     def __repr__(self):
         return "const ({})".format(self.val)
 
-    def unify(self, other) ->\
-            typing.Union[typing.List[typing.Tuple[typing.Any, Value]], None]:
-        return other.unify_with_const(self.val)
-
-    def unify_with_const(self, val):
-        if self.val == val:
-            return []
-        else:
-            return None
-
-    def unify_with_pair(self, a, b):
-        return None
-
-    def unify_with_var(self, ref):
-        return RefValue(ref).unify_with_const(self.val)
+    def same(self, other: 'Value') -> bool:
+        return isinstance(other, ConstValue) and self.val == other.val
 
     def has_occurrence(self, ref):
         return False
 
+    def functor(self):
+        try:
+            hash(self.val)
+        except TypeError:
+            return None
+        return 'const', self.val
+
+    def intern_key(self):
+        functor = self.functor()
+        if functor is None:
+            return None
+        return functor + (type(self.val),)
+
     def get_free_vars(self):
         return []
 
-    def substitute_ref(self, old_ref, new_ref):
-        return self
-
 
 class PairValue(Value):
+    __slots__ = ('value1', 'value2', 'ground')
+
     def __init__(self, value1: Value, value2: Value):
         self.value1: Value = value1
         self.value2: Value = value2
+        self.ground: bool = value1.ground and value2.ground
 
     def value(self):
         return self.car().value(), self.cdr().value()
@@ -343,46 +891,25 @@ class PairValue(Value):
     def cdr(self):
         return self.value2
 
-    def clone(self):
-        return PairValue(self.value1.clone(), self.value2.clone())
-
-    def substitute(self, ref, value: Value):
-        return PairValue(self.value1.substitute(ref, value),
-                         self.value2.substitute(ref, value))
-
     def __repr__(self):
         return "pair ({}), ({})".format(self.value1, self.value2)
 
-    def unify_with_const(self, const):
-        return None
-
-    def unify_with_pair(self, a: Value, b: Value):
-        subst1 = self.value1.unify(a)
-        if subst1 is None:
-            return None
-        subst2 = self.value2.unify(b)
-        if subst2 is None:
-            return None
-        return subst1 + subst2
-
-    def unify_with_var(self, ref):
-        return RefValue(ref).unify_with_pair(self.value1, self.value2)
-
-    def unify(self, other):
-        return other.unify_with_pair(self.value1, self.value2)
-
     def has_occurrence(self, ref):
         return self.value1.has_occurrence(ref) or self.value2.has_occurrence(ref)
 
+    def functor(self):
+        return 'pair'
+
+    def intern_key(self):
+        return 'pair', id(self.value1), id(self.value2)
+
     def get_free_vars(self):
         return self.value1.get_free_vars() + self.value2.get_free_vars()
 
-    def substitute_ref(self, old_ref, new_ref):
-        return PairValue(self.value1.substitute_ref(old_ref, new_ref),
-                         self.value2.substitute_ref(old_ref, new_ref))
-
 
 class RefValue(Value):
+    __slots__ = ('ref',)
+
     def __init__(self, ref):
         self.ref = ref
 
@@ -395,121 +922,2030 @@ class RefValue(Value):
     def cdr(self):
         raise Exception("value not assigned")
 
-    def clone(self):
-        return RefValue(self.ref)
-
-    def substitute(self, ref, value: Value) -> Value:
-        if self.ref == ref:
-            return value
-        else:
+    def deref(self, store):
+        value = store.items.get(self.ref)
+        if value is None:
             return self
+        return store.find(self.ref, value)
 
     def __repr__(self):
         return "ref ({})".format(self.ref)
 
-    def unify(self, other: Value):
-        return other.unify_with_var(self.ref)
+    def has_occurrence(self, ref):
+        return self.ref == ref
 
-    def unify_with_const(self, value):
-        return [(self.ref, ConstValue(value))]
+    def functor(self):
+        return None
 
-    def unify_with_pair(self, a: Value, b: Value):
-        if a.has_occurrence(self.ref) or b.has_occurrence(self.ref):
+    def intern_key(self):
+        return None
+
+    def get_free_vars(self):
+        return [self.ref]
+
+
+class Unbound:
+    def __init__(self, ref):
+        self.ref = ref
+
+    def __eq__(self, other):
+        return isinstance(other, Unbound) and self.ref == other.ref
+
+    def __hash__(self):
+        return hash(self.ref)
+
+    def __repr__(self):
+        return "_{}".format(self.ref)
+
+
+UNBOUND_CELL = 0
+CONST_CELL = 1
+REF_CELL = 2
+PAIR_CELL = 3
+GROUND_PAIR_CELL = 4
+
+CHUNK_BITS = 10
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+class CellHeap(typing.MutableMapping):
+    """Term cells in chunks of two typed arrays, indexed by ref.
+
+    A pair cell points at two consecutive cells holding its car and cdr,
+    a const cell holds an index into the constant table. Refs are never
+    reused, so collection frees memory by dropping the chunks left without
+    a live cell and by compacting the constant table."""
+
+    def __init__(self, next_ref: NextRef):
+        self.next_ref = next_ref
+        self.tags: typing.List[typing.Optional[array.array]] = []
+        self.payloads: typing.List[typing.Optional[array.array]] = []
+        self.constants: typing.List[ConstValue] = []
+        self.constant_ids: typing.Dict[typing.Any, int] = {}
+        self.constant_objects: typing.Dict[int, int] = {}
+
+    def reserve(self, ref):
+        chunk = ref >> CHUNK_BITS
+        if chunk >= len(self.tags):
+            grow = chunk + 1 - len(self.tags)
+            self.tags.extend([None] * grow)
+            self.payloads.extend([None] * grow)
+        if self.tags[chunk] is None:
+            self.tags[chunk] = array.array('b', bytes(CHUNK_SIZE))
+            self.payloads[chunk] = array.array('q', bytes(CHUNK_SIZE * 8))
+
+    def tag(self, ref) -> int:
+        try:
+            return self.tags[ref >> CHUNK_BITS][ref & CHUNK_MASK]
+        except (IndexError, TypeError):
+            return UNBOUND_CELL
+
+    def payload(self, ref) -> int:
+        return self.payloads[ref >> CHUNK_BITS][ref & CHUNK_MASK]
+
+    def set_cell(self, ref, tag, payload):
+        chunk = ref >> CHUNK_BITS
+        try:
+            self.tags[chunk][ref & CHUNK_MASK] = tag
+        except (IndexError, TypeError):
+            self.reserve(ref)
+            self.tags[chunk][ref & CHUNK_MASK] = tag
+        self.payloads[chunk][ref & CHUNK_MASK] = payload
+
+    def capacity(self) -> int:
+        return sum(len(tags) for tags in self.tags if tags is not None)
+
+    def constant_id(self, value: ConstValue) -> int:
+        const_id = self.constant_objects.get(id(value))
+        if const_id is not None:
+            return const_id
+        key = value.intern_key()
+        if key is not None:
+            const_id = self.constant_ids.get(key)
+            if const_id is not None:
+                return const_id
+            self.constant_ids[key] = len(self.constants)
+        self.constant_objects[id(value)] = len(self.constants)
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    def cell(self, ref) -> typing.Optional[Value]:
+        chunk = ref >> CHUNK_BITS
+        offset = ref & CHUNK_MASK
+        try:
+            tag = self.tags[chunk][offset]
+        except (IndexError, TypeError):
+            return None
+        if tag == UNBOUND_CELL:
             return None
-        return [(self.ref, PairValue(a, b))]
+        payload = self.payloads[chunk][offset]
+        if tag == CONST_CELL:
+            return self.constants[payload]
+        if tag == REF_CELL:
+            return RefValue(payload)
+        return PairCell(self, payload, tag == GROUND_PAIR_CELL)
+
+    def child(self, address) -> Value:
+        value = self.cell(address)
+        if value is None:
+            return RefValue(address)
+        return value
 
-    def unify_with_var(self, ref):
-        if ref == self.ref:
-            return []
+    get = cell
+
+    def copy_cell(self, source, target):
+        try:
+            tag = self.tags[source >> CHUNK_BITS][source & CHUNK_MASK]
+        except (IndexError, TypeError):
+            tag = UNBOUND_CELL
+        if tag == UNBOUND_CELL:
+            self.set_cell(target, REF_CELL, source)
         else:
-            return [(self.ref, RefValue(ref))]
+            self.set_cell(target, tag, self.payloads[source >> CHUNK_BITS][source & CHUNK_MASK])
+
+    def make_pair(self, ref, ref1, ref2):
+        address = self.next_ref.get(2)
+        self.copy_cell(ref1, address)
+        self.copy_cell(ref2, address + 1)
+        ground = self.tag(address) in (CONST_CELL, GROUND_PAIR_CELL) and \
+            self.tag(address + 1) in (CONST_CELL, GROUND_PAIR_CELL)
+        self.set_cell(ref, GROUND_PAIR_CELL if ground else PAIR_CELL, address)
+
+    def trim(self):
+        for chunk, tags in enumerate(self.tags):
+            if tags is not None and tags.count(UNBOUND_CELL) == CHUNK_SIZE:
+                self.tags[chunk] = self.payloads[chunk] = None
+        size = len(self.tags)
+        while size and self.tags[size - 1] is None:
+            size -= 1
+        del self.tags[size:]
+        del self.payloads[size:]
+
+    def sweep_constants(self):
+        """Drops the constants no cell holds any more, renumbering the rest."""
+        used = set()
+        for tags, payloads in zip(self.tags, self.payloads):
+            if tags is not None:
+                used.update(payload for tag, payload in zip(tags, payloads) if tag == CONST_CELL)
+        renumbered = {const_id: number for number, const_id in enumerate(sorted(used))}
+        for tags, payloads in zip(self.tags, self.payloads):
+            if tags is not None:
+                for offset, tag in enumerate(tags):
+                    if tag == CONST_CELL:
+                        payloads[offset] = renumbered[payloads[offset]]
+        self.constants = [self.constants[const_id] for const_id in sorted(used)]
+        self.constant_objects = {id(value): const_id for const_id, value in enumerate(self.constants)}
+        self.constant_ids = {key: renumbered[const_id] for key, const_id in self.constant_ids.items()
+                             if const_id in renumbered}
+
+    def __getitem__(self, ref) -> Value:
+        value = self.cell(ref)
+        if value is None:
+            raise KeyError(ref)
+        return value
 
-    def has_occurrence(self, ref):
-        return self.ref == ref
+    def __setitem__(self, ref, value: Value):
+        if isinstance(value, ConstValue):
+            self.set_cell(ref, CONST_CELL, self.constant_id(value))
+            return
+        stack = [(ref, value)]
+        while stack:
+            ref, value = stack.pop()
+            if isinstance(value, PairCell) and value.heap is self:
+                self.set_cell(ref, GROUND_PAIR_CELL if value.ground else PAIR_CELL, value.address)
+            elif isinstance(value, PairValue):
+                address = self.next_ref.get(2)
+                self.set_cell(ref, GROUND_PAIR_CELL if value.ground else PAIR_CELL, address)
+                stack.append((address + 1, value.cdr()))
+                stack.append((address, value.car()))
+            elif isinstance(value, RefValue):
+                self.set_cell(ref, REF_CELL, value.ref)
+            else:
+                self.set_cell(ref, CONST_CELL, self.constant_id(value))
+
+    def __delitem__(self, ref):
+        if ref not in self:
+            raise KeyError(ref)
+        self.tags[ref >> CHUNK_BITS][ref & CHUNK_MASK] = UNBOUND_CELL
+
+    def __contains__(self, ref):
+        return self.tag(ref) != UNBOUND_CELL
+
+    def __iter__(self):
+        for chunk, tags in enumerate(self.tags):
+            if tags is not None:
+                base = chunk << CHUNK_BITS
+                yield from (base + offset for offset, tag in enumerate(tags) if tag != UNBOUND_CELL)
+
+    def __len__(self):
+        return sum(CHUNK_SIZE - tags.count(UNBOUND_CELL) for tags in self.tags if tags is not None)
+
+
+class PairCell(PairValue):
+    __slots__ = ('heap', 'address')
+
+    def __init__(self, heap: CellHeap, address, ground: bool):
+        self.heap = heap
+        self.address = address
+        self.ground = ground
+
+    @property
+    def value1(self) -> Value:
+        return self.heap.child(self.address)
+
+    @property
+    def value2(self) -> Value:
+        return self.heap.child(self.address + 1)
+
+    def car(self):
+        return self.heap.child(self.address)
+
+    def cdr(self):
+        return self.heap.child(self.address + 1)
+
+    def intern_key(self):
+        return 'cell', id(self.heap), self.address
 
-    def get_free_vars(self):
-        return [self.ref]
 
-    def substitute_ref(self, old_ref, new_ref):
-        if self.ref == old_ref:
-            return RefValue(new_ref)
+class StoreSnapshot:
+    def __init__(self, store: 'ArrayStore'):
+        heap = store.items
+        self.tags = [None if tags is None else tags.tobytes() for tags in heap.tags]
+        self.payloads = [None if payloads is None else payloads.tobytes() for payloads in heap.payloads]
+        self.constants = list(heap.constants)
+        self.constant_ids = dict(heap.constant_ids)
+        self.next_ref = store.next_ref.value
+        self.variables = dict(store.variables)
+        self.ranks = dict(store.ranks)
+        self.trail = list(store.trail)
+        self.boundary = store.boundary
+        self.depth = store.depth
+
+
+class ArrayStore(Store):
+    """Store keeping its cells in a CellHeap instead of a dict of values.
+
+    A cell takes about ten bytes instead of a dict slot and an object, and a
+    snapshot is a copy of the arrays. Cells are decoded in Python on every
+    read though, so terms are slower to walk than on Store: car and cdr take
+    about a third longer and interpreted search up to twice as long."""
+
+    items: CellHeap
+
+    def empty_items(self) -> CellHeap:
+        return CellHeap(self.next_ref)
+
+    def make_pair(self, ref1, ref2):
+        ref = self.next_ref.get()
+        self.items.reserve(ref)
+        self.items.make_pair(ref, ref1, ref2)
+        return ref
+
+    def car(self, ref):
+        return self.copy_child(ref, 0)
+
+    def cdr(self, ref):
+        return self.copy_child(ref, 1)
+
+    def get_item_or_ref(self, ref):
+        value = self.items.cell(ref)
+        if value is None:
+            return RefValue(ref)
+        return self.find(ref, value)
+
+    def deref(self, value: 'Value') -> 'Value':
+        if isinstance(value, RefValue):
+            next_value = self.items.cell(value.ref)
+            if next_value is not None:
+                return self.find(value.ref, next_value)
+        return value
+
+    def copy_child(self, ref, offset):
+        """Copies the cell of the car or cdr straight from the arrays, without
+        building a view of the pair unless ref has to be dereferenced."""
+        heap = self.items
+        try:
+            tag = heap.tags[ref >> CHUNK_BITS][ref & CHUNK_MASK]
+        except (IndexError, TypeError):
+            tag = UNBOUND_CELL
+        if tag == PAIR_CELL or tag == GROUND_PAIR_CELL:
+            address = heap.payloads[ref >> CHUNK_BITS][ref & CHUNK_MASK]
         else:
-            return self
+            pair = self.get_item(ref)
+            if not isinstance(pair, PairCell):
+                raise Exception("not a pair")
+            address = pair.address
+        res = self.next_ref.get()
+        heap.copy_cell(address + offset, res)
+        return res
+
+    def sweep(self, live):
+        super().sweep(live)
+        self.items.trim()
+        self.items.sweep_constants()
+
+    def snapshot(self) -> StoreSnapshot:
+        return StoreSnapshot(self)
+
+    def restore(self, snapshot: StoreSnapshot):
+        heap = self.items
+        heap.tags = [None if tags is None else array.array('b', tags) for tags in snapshot.tags]
+        heap.payloads = [None if payloads is None else array.array('q', payloads)
+                         for payloads in snapshot.payloads]
+        heap.constants = list(snapshot.constants)
+        heap.constant_objects = {id(value): const_id for const_id, value in enumerate(heap.constants)}
+        heap.constant_ids = dict(snapshot.constant_ids)
+        self.next_ref.value = snapshot.next_ref
+        self.variables = dict(snapshot.variables)
+        self.ranks.clear()
+        self.ranks.update(snapshot.ranks)
+        self.trail[:] = snapshot.trail
+        self.boundary = snapshot.boundary
+        self.depth = snapshot.depth
+
+
+global_store = Store()
+default_engine = Engine(global_store)
 
 
-L = C.make_const(None)
+def use_store(store: Store) -> Store:
+    """Make store the one of the default engine, used by Handle, C, V and
+    Prolog unless given another engine; returns the previous one.
+
+    Every store starts with the empty list at the same ref, so L stays valid."""
+    global global_store
+    previous = global_store
+    global_store = default_engine.store = store
+    return previous
+
+
+C = default_engine.C
+V = default_engine.V
+L = default_engine.L
 
 
 class Predicate:
     def go(self, query: typing.Union['Handle', 'HandleConjunction'], do: typing.Callable):
         raise NotImplementedError()
 
+    def resolve(self, query: Handle, strict=True) -> typing.Optional[HandleConjunction]:
+        raise NotImplementedError()
+
     def with_new_free_variables(self):
         raise NotImplementedError()
 
+    def head_handle(self) -> Handle:
+        raise NotImplementedError()
+
+    def compile(self) -> 'CompiledClause':
+        raise NotImplementedError()
+
+    def unify_head(self, subst, query: Handle, strict: bool) -> bool:
+        """Unifies the head renamed by subst with query, using the occurs check
+        only where a variable could be bound to a term containing it.
+
+        A head in which no variable repeats shares no variables with query, so
+        unifying them never needs the check; neither does unifying any head
+        with a ground query. Otherwise the head is unified with the repeated
+        occurrences of its variables replaced by fresh ones, and only the
+        equations between those and the originals are checked, as compiled
+        code does in unify_val."""
+        if strict:
+            return self.head_handle().substitute(subst).unify(query)
+        store = query.engine_.store
+        if self.linear_head is None:
+            ref, repeats = store.linearize(self.head_handle().ref_)
+            self.linear_head = Handle(ref, query.engine_), repeats
+        head, repeats = self.linear_head
+        if not repeats or store.get_item_or_ref(query.ref_).ground:
+            return self.head_handle().substitute(subst).unify(query, False)
+        subst = subst + [(copy, store.next_ref.get()) for _, copy in repeats]
+        if not head.substitute(subst).unify(query, False):
+            return False
+        renamed = dict(subst)
+        return all(store.unify_values(RefValue(renamed[ref]), RefValue(renamed[copy]))
+                   for ref, copy in repeats)
+
 
 class Fact(Predicate):
     def __init__(self, a: Handle):
         self.a: Handle = a
+        self.free_vars = None
+        self.linear_head: typing.Optional[typing.Tuple[Handle, list]] = None
+        self.compiled = None
 
     def go(self, a: Handle, do: typing.Callable):
-        copy = self.with_new_free_variables()
-        copy.a.go(a, do)
+        store = self.a.engine_.store
+        point = store.push_choice()
+        try:
+            if self.resolve(a) is not None:
+                do()
+        finally:
+            store.pop_choice(point)
+
+    def resolve(self, a: Handle, strict=True):
+        if not self.a.could_match(a):
+            return None
+        subst = self.a.engine_.store.clone_variables(self.get_free_variables())
+        if not self.unify_head(subst, a, strict):
+            return None
+        return HandleConjunction([])
 
     def __repr__(self):
         return "Fact({})".format(self.a)
 
+    def get_free_variables(self):
+        if self.free_vars is None:
+            self.free_vars = self.a.get_free_variables()
+        return self.free_vars
+
     def with_new_free_variables(self):
-        free_vars = self.a.get_free_variables()
-        subst = global_store.clone_variables(free_vars)
+        subst = self.a.engine_.store.clone_variables(self.get_free_variables())
         new_a = self.a.substitute(subst)
         return Fact(new_a)
 
+    def head_handle(self):
+        return self.a
+
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = CompiledClause.compile(self.a, [])
+        return self.compiled
+
 
 class HeadBody(Predicate):
-    def __init__(self, prolog: 'Prolog', head: Handle, body: HandleConjunction):
+    def __init__(self, prolog: 'Prolog', head: Handle, body: HandleConjunction, reorder=False):
         self.head: Handle = head
         self.body: HandleConjunction = body
         self.prolog: Prolog = prolog
+        self.reorder = reorder
+        self.free_vars = None
+        self.linear_head: typing.Optional[typing.Tuple[Handle, list]] = None
+        self.compiled = None
 
     def go(self, query: Handle, do: typing.Callable):
-        copy = self.with_new_free_variables()
-
-        def inner_do():
-            self.prolog.go(copy.body, do)
-
-        copy.head.go(query, inner_do)
+        point = self.prolog.store.push_choice()
+        try:
+            body = self.resolve(query)
+            if body is not None:
+                self.prolog.go(body, do)
+        finally:
+            self.prolog.store.pop_choice(point)
+
+    def resolve(self, query: Handle, strict=True):
+        if not self.head.could_match(query):
+            return None
+        subst = self.prolog.store.clone_variables(self.get_free_variables())
+        if not self.unify_head(subst, query, strict):
+            return None
+        body = self.body.substitute(subst).to_conjunction()
+        if self.reorder:
+            body = HandleConjunction(self.prolog.order_goals(body.handles))
+        return body
 
     def __repr__(self):
         return "HeadBody({}, {})".format(self.head, self.body)
 
+    def get_free_variables(self):
+        if self.free_vars is None:
+            self.free_vars = self.head.get_free_variables() + self.body.get_free_variables()
+        return self.free_vars
+
     def with_new_free_variables(self):
-        vars_head = self.head.get_free_variables()
-        vars_tail = self.body.get_free_variables()
-        subst = global_store.clone_variables(vars_head + vars_tail)
+        subst = self.prolog.store.clone_variables(self.get_free_variables())
         new_head = self.head.substitute(subst)
         new_body = self.body.substitute(subst)
-        return HeadBody(self.prolog, new_head, new_body)
+        return HeadBody(self.prolog, new_head, new_body, self.reorder)
 
+    def head_handle(self):
+        return self.head
 
-class Prolog:
+    def compile(self):
+        if self.compiled is None:
+            body = self.body.to_conjunction().handles
+            if self.reorder:
+                body = self.prolog.order_goals(body)
+            self.compiled = CompiledClause.compile(self.head, body)
+        return self.compiled
+
+
+class Row(Predicate):
+    def __init__(self, relation: 'Relation', position: int):
+        self.relation = relation
+        self.position = position
+
+    def go(self, query: Handle, do: typing.Callable):
+        store = self.relation.engine.store
+        point = store.push_choice()
+        try:
+            if self.resolve(query) is not None:
+                do()
+        finally:
+            store.pop_choice(point)
+
+    def resolve(self, query: Handle, strict=True):
+        store = self.relation.engine.store
+        if not store.unify_values(store.get_item_or_ref(query.ref_),
+                                  self.relation.term(self.position)):
+            return None
+        return HandleConjunction([])
+
+    def with_new_free_variables(self):
+        return self
+
+    def compile(self):
+        code = []
+        CompiledClause.compile_head(self.relation.engine.store, self.relation.term(self.position), {}, code)
+        code.append((PROCEED, None))
+        return CompiledClause(code, 0)
+
+    def __repr__(self):
+        return "Row({})".format(self.relation.row(self.position))
+
+
+class StoredClause(Predicate):
+    """A clause of a program image, decoded on first use."""
+
+    def __init__(self, prolog: 'Prolog', image, start: int, stop: int):
+        self.prolog = prolog
+        self.image = image
+        self.start = start
+        self.stop = stop
+        self.decoded: typing.Optional[Predicate] = None
+
+    def data(self):
+        return pickle.loads(self.image[self.start:self.stop])
+
+    def clause(self) -> Predicate:
+        if self.decoded is None:
+            self.decoded = self.prolog.decode_clause(self.data())
+        return self.decoded
+
+    def go(self, query: Handle, do: typing.Callable):
+        self.clause().go(query, do)
+
+    def resolve(self, query: Handle, strict=True):
+        return self.clause().resolve(query, strict)
+
+    def with_new_free_variables(self):
+        return self.clause().with_new_free_variables()
+
+    def head_handle(self):
+        return self.clause().head_handle()
+
+    def compile(self):
+        return self.clause().compile()
+
+    def __repr__(self):
+        return "StoredClause({})".format(self.clause())
+
+
+class Builtin(Predicate):
+    """A predicate computed in Python: function is called with the store and
+    the goal's dereferenced arguments, binds variables through the store and
+    tells whether the goal holds."""
+
+    def __init__(self, tag, arity: int, function: typing.Callable[..., bool]):
+        self.tag = tag
+        self.arity = arity
+        self.function = function
+        self.compiled = None
+
+    def call(self, store: 'Store', goal: 'Value') -> bool:
+        if self.function is None:
+            raise Exception("builtin {} has to be registered again".format(self.tag))
+        if not self.arity:
+            return not isinstance(store.deref(goal), PairValue) and bool(self.function(store))
+        arguments = store.arguments(goal, self.arity)
+        return bool(arguments) and self.function(store, *arguments)
+
+    def go(self, query: Handle, do: typing.Callable):
+        store = query.engine_.store
+        point = store.push_choice()
+        try:
+            if self.resolve(query) is not None:
+                do()
+        finally:
+            store.pop_choice(point)
+
+    def resolve(self, query: Handle, strict=True):
+        store = query.engine_.store
+        if not self.call(store, store.get_item_or_ref(query.ref_)):
+            return None
+        return HandleConjunction([])
+
+    def with_new_free_variables(self):
+        return self
+
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = CompiledClause([(BUILTIN, self), (PROCEED, None)], 0)
+        return self.compiled
+
+    def __repr__(self):
+        return "Builtin({}/{})".format(self.tag, self.arity)
+
+
+class Answer(Predicate):
+    """One answer of a foreign predicate, a goal term to unify with."""
+
+    def __init__(self, term: 'Value'):
+        self.term = term
+
+    def resolve(self, query: Handle, strict=True):
+        store = query.engine_.store
+        if not store.unify_values(store.get_item_or_ref(query.ref_), self.term):
+            return None
+        return HandleConjunction([])
+
+    def with_new_free_variables(self):
+        return self
+
+    def __repr__(self):
+        return "Answer({})".format(self.term)
+
+
+class Foreign:
+    """A predicate whose answers come from a Python function or generator.
+
+    function gets the goal's arguments as python values, Unbound for unbound
+    variables and pairs for pairs, and yields a sequence of arity such values
+    per answer, which is unified with the arguments; yielding an Unbound back
+    leaves its argument as it was. Answers are only asked for as the search backtracks into them."""
+
+    def __init__(self, tag, arity: int, function: typing.Callable[..., typing.Iterable[typing.Sequence]]):
+        self.tag = ConstValue(tag)
+        self.arity = arity
+        self.function = function
+
+    def answers(self, store: 'Store', goal: 'Value') -> typing.Iterator[Answer]:
+        if self.function is None:
+            raise Exception("foreign predicate {} has to be registered again".format(self.tag.val))
+        if not self.arity:
+            if isinstance(store.deref(goal), PairValue):
+                return
+            arguments = []
+        else:
+            arguments = store.arguments(goal, self.arity)
+            if not arguments:
+                return
+        for row in self.function(*[store.python_value(argument, Unbound) for argument in arguments]):
+            if len(row) != self.arity:
+                raise Exception("foreign predicate {} has arity {}".format(self.tag.val, self.arity))
+            value = None
+            for item in row:
+                item = store.from_python(item)
+                value = item if value is None else PairValue(value, item)
+            yield Answer(self.tag if value is None else PairValue(value, self.tag))
+
+    def __repr__(self):
+        return "Foreign({}/{})".format(self.tag.val, self.arity)
+
+
+ARITHMETIC = {
+    '+': (2, operator.add),
+    '-': (2, operator.sub),
+    '*': (2, operator.mul),
+    '/': (2, operator.truediv),
+    '//': (2, operator.floordiv),
+    'mod': (2, operator.mod),
+    '**': (2, operator.pow),
+    'min': (2, min),
+    'max': (2, max),
+    'neg': (1, operator.neg),
+    'abs': (1, abs),
+}
+
+
+def evaluate(store: 'Store', value: 'Value'):
+    """The number an arithmetic expression stands for: a numeric constant, or
+    the arguments of an operation from ARITHMETIC followed by its name."""
+    stack = [(value, None)]
+    results = []
+    while stack:
+        value, operation = stack.pop()
+        if operation is not None:
+            arity, function = operation
+            arguments = results[len(results) - arity:]
+            del results[len(results) - arity:]
+            results.append(function(*arguments))
+            continue
+        value = store.deref(value)
+        if isinstance(value, ConstValue):
+            if isinstance(value.val, bool) or not isinstance(value.val, (int, float)):
+                raise Exception("{} is not a number".format(value.val))
+            results.append(value.val)
+        elif isinstance(value, PairValue):
+            functor = store.deref(value.cdr()).functor()
+            operation = ARITHMETIC.get(functor[1]) if isinstance(functor, tuple) and \
+                isinstance(functor[1], str) else None
+            arguments = store.arguments(value, operation[0]) if operation is not None else None
+            if not arguments:
+                raise Exception("{} is not an arithmetic expression".format(store.python_value(value)))
+            stack.append((None, operation))
+            stack.extend((argument, None) for argument in reversed(arguments))
+        else:
+            raise Exception("arithmetic on an unbound variable")
+    return results[0]
+
+
+def builtin_is(store: 'Store', result: 'Value', expression: 'Value') -> bool:
+    return store.unify_values(result, store.intern(ConstValue(evaluate(store, expression))))
+
+
+def builtin_comparison(compare: typing.Callable[[typing.Any, typing.Any], bool]):
+    return lambda store, left, right: compare(evaluate(store, left), evaluate(store, right))
+
+
+BUILTINS = {('const', builtin.tag): builtin for builtin in [
+    Builtin('is', 2, builtin_is),
+    Builtin('<', 2, builtin_comparison(operator.lt)),
+    Builtin('>', 2, builtin_comparison(operator.gt)),
+    Builtin('=<', 2, builtin_comparison(operator.le)),
+    Builtin('>=', 2, builtin_comparison(operator.ge)),
+    Builtin('=:=', 2, builtin_comparison(operator.eq)),
+    Builtin('=\\=', 2, builtin_comparison(operator.ne)),
+    Builtin('var', 1, lambda store, value: isinstance(value, RefValue)),
+    Builtin('nonvar', 1, lambda store, value: not isinstance(value, RefValue)),
+    Builtin('atomic', 1, lambda store, value: isinstance(value, ConstValue)),
+]}
+
+
+class Relation:
+    """Ground facts with the same tag and arity, one column per argument.
+
+    Goals are matched by looking their bound arguments up in per-column hash
+    indexes, built on first use, so only matching rows are unified."""
+
+    unhashable = object()
+
+    def __init__(self, tag, engine: Engine):
+        self.tag = ConstValue(tag)
+        self.engine = engine
+        self.arity: typing.Optional[int] = None
+        self.size = 0
+        self.columns: typing.List[list] = []
+        self.indexes: typing.List[typing.Optional[typing.Dict[typing.Any, typing.List[int]]]] = []
+
+    def extend(self, rows: typing.Iterable[typing.Sequence]):
+        for row in rows:
+            if self.arity is None:
+                self.arity = len(row)
+                self.columns = [[] for _ in row]
+                self.indexes = [None for _ in row]
+            if len(row) != self.arity:
+                raise Exception("relation {} has arity {}".format(self.tag.val, self.arity))
+            for column, index, item in zip(self.columns, self.indexes, row):
+                if isinstance(item, Handle):
+                    raise Exception("relation rows hold constants")
+                if index is not None:
+                    try:
+                        index.setdefault(item, []).append(self.size)
+                    except TypeError:
+                        index[Relation.unhashable] = None
+                column.append(item)
+            self.size += 1
+
+    def row(self, position) -> tuple:
+        return tuple(column[position] for column in self.columns)
+
+    def term(self, position) -> 'Value':
+        value = None
+        for column in self.columns:
+            item = ConstValue(column[position])
+            value = item if value is None else PairValue(value, item)
+        return self.tag if value is None else PairValue(value, self.tag)
+
+    def arguments(self, goal: 'Value') -> typing.Optional[typing.List['Value']]:
+        """The goal's arguments, dereferenced; None where a variable stands for
+        some of them, [] if the goal cannot match any row."""
+        return self.engine.store.arguments(goal, self.arity)
+
+    def index(self, number) -> typing.Optional[typing.Dict[typing.Any, typing.List[int]]]:
+        index = self.indexes[number]
+        if index is None:
+            index = {}
+            try:
+                for position, item in enumerate(self.columns[number]):
+                    index.setdefault(item, []).append(position)
+            except TypeError:
+                index[Relation.unhashable] = None
+            self.indexes[number] = index
+        if Relation.unhashable in index:
+            return None
+        return index
+
+    def matches(self, goal: 'Value') -> typing.Iterable[int]:
+        if not self.arity:
+            return range(self.size)
+        arguments = self.arguments(goal)
+        if arguments is None:
+            return range(self.size)
+        return self.select(arguments)
+
+    def select(self, arguments: typing.List['Value']) -> typing.Iterable[int]:
+        if not arguments:
+            return []
+        bound = []
+        for number, argument in enumerate(arguments):
+            if isinstance(argument, PairValue):
+                return []
+            if isinstance(argument, ConstValue):
+                bound.append((number, argument.val))
+        if not bound:
+            return range(self.size)
+        best = None
+        for number, val in bound:
+            index = self.index(number)
+            if index is None:
+                continue
+            try:
+                positions = index.get(val, [])
+            except TypeError:
+                continue
+            if best is None or len(positions) < len(best):
+                best = positions
+        if best is None:
+            best = range(self.size)
+        columns = self.columns
+        return [position for position in best
+                if all(columns[number][position] == val for number, val in bound)]
+
+    def candidates(self, goal: 'Value') -> typing.List[Row]:
+        return [Row(self, position) for position in self.matches(goal)]
+
+
+class ClauseIndex:
     def __init__(self):
+        self.clauses: typing.List[typing.Tuple[typing.Any, Predicate]] = []
+        self.primary: typing.Dict[typing.Any, typing.List[int]] = {}
+        self.buckets: typing.Dict[typing.Any, typing.Dict[typing.Any, typing.List[int]]] = {}
+        self.unindexed: typing.List[int] = []
+
+    def add(self, predicate: Predicate):
+        self.extend([(predicate.head_handle().index_key(), predicate)])
+
+    def extend(self, clauses: typing.List[typing.Tuple[typing.Any, Predicate]]):
+        start = len(self.clauses)
+        self.clauses.extend(clauses)
+        primary_lists = {}
+        for position, ((primary, first), _) in enumerate(clauses, start):
+            if primary is None:
+                self.unindexed.append(position)
+            else:
+                positions = primary_lists.get(primary)
+                if positions is None:
+                    positions = primary_lists[primary] = []
+                positions.append((self.bucket_key(first), position))
+        for primary, positions in primary_lists.items():
+            self.primary.setdefault(primary, []).extend(position for _, position in positions)
+            bucket = self.buckets.setdefault(primary, {})
+            for first, position in positions:
+                bucket.setdefault(first, []).append(position)
+
+    @staticmethod
+    def bucket_key(first):
+        if first is None or first[1] is None:
+            return None
+        return first
+
+    @staticmethod
+    def compatible(first1, first2):
+        if first1 is None or first2 is None:
+            return True
+        (depth1, functor1), (depth2, functor2) = first1, first2
+        if functor1 is None:
+            return functor2 is None or depth2 >= depth1
+        if functor2 is None:
+            return depth1 >= depth2
+        return first1 == first2
+
+    def positions(self, primary, first):
+        if primary is None:
+            return range(len(self.clauses))
+        first = self.bucket_key(first)
+        if first is None:
+            lists = [self.primary.get(primary, [])]
+        else:
+            bucket = self.buckets.get(primary, {})
+            lists = [bucket.get(first, []), bucket.get(None, [])]
+        lists.append(self.unindexed)
+        lists = [positions for positions in lists if positions]
+        if len(lists) == 1:
+            return lists[0]
+        return heapq.merge(*lists)
+
+    def candidates(self, key) -> typing.List[Predicate]:
+        primary, first = key
+        result = []
+        for position in self.positions(primary, first):
+            clause_key, predicate = self.clauses[position]
+            if self.compatible(clause_key[1], first):
+                result.append(predicate)
+        return result
+
+
+GET_CONST = 'get_const'
+GET_PAIR = 'get_pair'
+UNIFY_VAR = 'unify_var'
+UNIFY_VAL = 'unify_val'
+PUT_TERM = 'put_term'
+PUT_VAR = 'put_var'
+PUT_VAL = 'put_val'
+PUT_PAIR = 'put_pair'
+CALL = 'call'
+EXECUTE = 'execute'
+PROCEED = 'proceed'
+TRY = 'try'
+RETRY = 'retry'
+TRUST = 'trust'
+BUILTIN = 'builtin'
+FOREIGN = 'foreign'
+RETRY_FOREIGN = 'retry_foreign'
+
+
+class CompiledClause:
+    def __init__(self, code: typing.List[typing.Tuple[str, typing.Any]], size: int):
+        self.code = code
+        self.size = size
+
+    def __repr__(self):
+        return "CompiledClause({})".format(self.code)
+
+    @staticmethod
+    def compile(head: Handle, body: typing.List[Handle]) -> 'CompiledClause':
+        store = head.engine_.store
+        slots = {}
+        code = []
+        CompiledClause.compile_head(store, store.get_item_or_ref(head.ref_), slots, code)
+        for goal in body:
+            CompiledClause.compile_goal(store, store.get_item_or_ref(goal.ref_), slots, code)
+            code.append((CALL, None))
+        if code and code[-1][0] is CALL:
+            code[-1] = (EXECUTE, None)
+        else:
+            code.append((PROCEED, None))
+        CompiledClause.trim(code)
+        return CompiledClause(code, len(slots))
+
+    @staticmethod
+    def trim(code):
+        assigned = {}
+        for position, (op, arg) in enumerate(code):
+            if op is UNIFY_VAR or op is PUT_VAR:
+                assigned.setdefault(arg, position)
+        live = set()
+        dead = {}
+        for position in reversed(range(len(code))):
+            op, arg = code[position]
+            if op is PUT_VAL:
+                live.add(arg)
+            elif op is CALL:
+                dead[position] = {slot for slot, assigned_at in assigned.items()
+                                  if assigned_at < position and slot not in live}
+        trimmed = set()
+        for position in sorted(dead):
+            code[position] = (CALL, tuple(sorted(dead[position] - trimmed)) or None)
+            trimmed |= dead[position]
+
+    @staticmethod
+    def compile_head(store: 'Store', value: 'Value', slots, code):
+        stack = [value]
+        while stack:
+            value = store.deref(stack.pop())
+            if isinstance(value, RefValue):
+                if value.ref in slots:
+                    code.append((UNIFY_VAL, slots[value.ref]))
+                else:
+                    slots[value.ref] = len(slots)
+                    code.append((UNIFY_VAR, slots[value.ref]))
+            elif isinstance(value, PairValue):
+                code.append((GET_PAIR, None))
+                stack.append(value.cdr())
+                stack.append(value.car())
+            else:
+                code.append((GET_CONST, value))
+
+    @staticmethod
+    def compile_goal(store: 'Store', value: 'Value', slots, code):
+        stack = [(value, False)]
+        while stack:
+            value, built = stack.pop()
+            if built:
+                code.append((PUT_PAIR, None))
+                continue
+            value = store.deref(value)
+            if isinstance(value, RefValue):
+                if value.ref in slots:
+                    code.append((PUT_VAL, slots[value.ref]))
+                else:
+                    slots[value.ref] = len(slots)
+                    code.append((PUT_VAR, slots[value.ref]))
+            elif isinstance(value, PairValue):
+                stack.append((value, True))
+                stack.append((value.cdr(), False))
+                stack.append((value.car(), False))
+            else:
+                code.append((PUT_TERM, value))
+
+
+class Machine:
+    def __init__(self, prolog: 'Prolog'):
+        self.prolog: Prolog = prolog
+
+    def select(self, goal: 'Value') -> typing.List[CompiledClause]:
+        candidates = self.prolog.candidates(goal)
+        if not isinstance(candidates, list):
+            return [CompiledClause([(FOREIGN, candidates)], 0)]
+        return [predicate.compile() for predicate in candidates]
+
+    @staticmethod
+    def procedure(clauses: typing.List[CompiledClause]):
+        return [(TRY, clauses[0])] + [(RETRY, clause) for clause in clauses[1:-1]] + \
+            [(TRUST, clauses[-1])]
+
+    def solutions(self, goals: typing.List['Value']):
+        store = self.prolog.store
+        code = [instruction for goal in goals for instruction in ((PUT_TERM, goal), (CALL, None))]
+        if code:
+            code[-1] = (EXECUTE, None)
+        else:
+            code.append((PROCEED, None))
+        pc = 0
+        env = []
+        args = []
+        cont = None
+        goal = None
+        choices = []
+
+        def held():
+            yield goal
+            yield from env
+            yield from args
+            conts = [cont]
+            for choice in choices:
+                yield choice[2]
+                conts.append(choice[3])
+            seen = set()
+            while conts:
+                frame = conts.pop()
+                if frame is not None and id(frame) not in seen:
+                    seen.add(id(frame))
+                    yield from frame[2]
+                    conts.append(frame[3])
+
+        point = store.push_choice()
+        base = store.boundary
+        search = store.enter_search(held)
+        try:
+            while True:
+                op, arg = code[pc]
+                pc += 1
+                failed = False
+
+                if op is UNIFY_VAR:
+                    env[arg] = args.pop()
+                elif op is GET_CONST:
+                    value = store.deref(args.pop())
+                    if isinstance(value, RefValue):
+                        store.bind(value.ref, arg)
+                    else:
+                        failed = not arg.same(value)
+                elif op is GET_PAIR:
+                    value = store.deref(args.pop())
+                    if isinstance(value, PairValue):
+                        args.append(value.cdr())
+                        args.append(value.car())
+                    elif isinstance(value, RefValue):
+                        car = RefValue(store.next_ref.get())
+                        cdr = RefValue(store.next_ref.get())
+                        store.bind(value.ref, PairValue(car, cdr))
+                        args.append(cdr)
+                        args.append(car)
+                    else:
+                        failed = True
+                elif op is UNIFY_VAL:
+                    failed = not store.unify_values(env[arg], args.pop())
+                elif op is PUT_VAL:
+                    args.append(env[arg])
+                elif op is PUT_TERM:
+                    args.append(arg)
+                elif op is BUILTIN:
+                    failed = not arg.call(store, args.pop())
+                elif op is FOREIGN:
+                    store.boundary = store.next_ref.value
+                    choices.append((store.mark(), store.boundary, goal, cont,
+                                    [(RETRY_FOREIGN, arg), (PROCEED, None)], 0))
+                    failed = True
+                elif op is RETRY_FOREIGN:
+                    answer = next(arg, None)
+                    if answer is None:
+                        choices.pop()
+                        store.boundary = choices[-1][1] if choices else base
+                        failed = True
+                    else:
+                        failed = not store.unify_values(goal, answer.term)
+                elif op is PUT_PAIR:
+                    cdr = args.pop()
+                    args[-1] = PairValue(args[-1], cdr)
+                elif op is PUT_VAR:
+                    env[arg] = RefValue(store.next_ref.get())
+                    args.append(env[arg])
+                elif op is CALL or op is EXECUTE:
+                    goal = args.pop()
+                    if op is CALL:
+                        if arg is not None:
+                            env = list(env)
+                            for slot in arg:
+                                env[slot] = None
+                        cont = (code, pc, env, cont)
+                    if store.gc_threshold is not None:
+                        store.maybe_collect()
+                    clauses = self.select(goal)
+                    if not clauses:
+                        failed = True
+                    elif len(clauses) == 1:
+                        code, pc, env, args = clauses[0].code, 0, [None] * clauses[0].size, [goal]
+                    else:
+                        code, pc = self.procedure(clauses), 0
+                elif op is PROCEED:
+                    if cont is None:
+                        yield
+                        failed = True
+                    else:
+                        code, pc, env, cont = cont
+                        args = []
+                elif op is TRY:
+                    store.boundary = store.next_ref.value
+                    choices.append((store.mark(), store.boundary, goal, cont, code, pc))
+                    code, pc, env, args = arg.code, 0, [None] * arg.size, [goal]
+                elif op is RETRY:
+                    choices[-1] = choices[-1][:5] + (pc,)
+                    code, pc, env, args = arg.code, 0, [None] * arg.size, [goal]
+                elif op is TRUST:
+                    choices.pop()
+                    store.boundary = choices[-1][1] if choices else base
+                    code, pc, env, args = arg.code, 0, [None] * arg.size, [goal]
+
+                if failed:
+                    if not choices:
+                        return
+                    mark, store.boundary, goal, cont, code, pc = choices[-1]
+                    store.undo(mark)
+        finally:
+            store.leave_search(search)
+            store.pop_choice(point)
+
+
+class Solver:
+    def __init__(self, prolog: 'Prolog'):
+        self.prolog: Prolog = prolog
+        self.choices: typing.List[list] = []
+        self.base = math.inf
+
+    def boundary(self):
+        return self.choices[-1][1] if self.choices else self.base
+
+    def backtrack(self):
+        """Resolves the goal of the newest choice with its next candidate. The
+        one after it is fetched first, so the choice is dropped before its last
+        candidate runs."""
+        store = self.prolog.store
+        while self.choices:
+            choice = self.choices[-1]
+            mark, boundary, goal, rest, candidates, candidate = choice
+            store.undo(mark)
+            choice[5] = next(candidates, None)
+            if choice[5] is None:
+                self.choices.pop()
+                store.boundary = self.boundary()
+                if candidate is None:
+                    continue
+            else:
+                store.boundary = boundary
+            body = candidate.resolve(goal, self.prolog.occurs_check == 'strict')
+            if body is not None:
+                return True, body.prepend(rest)
+        return False, None
+
+    def held(self):
+        """Goals are handles; only the terms of foreign answers are bare."""
+        return (choice[5].term for choice in self.choices if isinstance(choice[5], Answer))
+
+    def solutions(self, goals: HandleConjunction):
+        store = self.prolog.store
+        point = store.push_choice()
+        self.base = store.boundary
+        search = store.enter_search(self.held)
+        pending = goals.goals
+        try:
+            while True:
+                if pending is None:
+                    yield
+                else:
+                    if store.gc_threshold is not None:
+                        store.maybe_collect()
+                    goal, rest = pending
+                    candidates = iter(self.prolog.candidates(store.get_item_or_ref(goal.ref_)))
+                    self.choices.append([store.mark(), store.next_ref.value,
+                                         goal, rest, candidates, next(candidates, None)])
+                found, pending = self.backtrack()
+                if not found:
+                    return
+        finally:
+            self.choices = []
+            store.leave_search(search)
+            store.pop_choice(point)
+
+
+class Table:
+    """Answers found so far for one call variant of a tabled predicate."""
+
+    def __init__(self):
+        self.answers: typing.List[Fact] = []
+        self.keys = set()
+        self.complete = False
+        self.depth: typing.Optional[int] = None
+        self.leader: typing.Optional[int] = None
+        self.scc: typing.Set[Table] = set()
+        self.owner: typing.Optional[Table] = None
+        self.stamp: typing.Optional[int] = None
+
+
+def term_size(term) -> int:
+    size = 0
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        size += sys.getsizeof(term)
+        if isinstance(term, tuple):
+            stack.extend(term)
+    return size
+
+
+class AnswerCache:
+    """LRU cache of complete solution sets keyed by program and exported query,
+    so several Prolog instances can share one."""
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.entries: typing.MutableMapping[typing.Any, tuple] = collections.OrderedDict()
+        self.keys_by_tag: typing.Dict[typing.Any, set] = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> typing.Optional[list]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, answers: list, tags: set):
+        if key in self.entries:
+            self.discard(key)
+        size = term_size(answers)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.entries[key] = (answers, tags, size)
+        self.bytes += size
+        for tag in tags:
+            self.keys_by_tag.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries or \
+                self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        answers, tags, size = self.entries.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self.keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_tag[tag]
+
+    def invalidate(self, tag):
+        """Drops the solution sets that depend on clauses tagged tag; a tag of None
+        (a clause whose tag is not known) drops everything."""
+        if tag is None:
+            keys = list(self.entries)
+        else:
+            keys = self.keys_by_tag.get(tag, set()) | self.keys_by_tag.get(None, set())
+        for key in keys:
+            self.discard(key)
+
+
+class Prolog:
+    program_ids = itertools.count()
+
+    def __init__(self, compiled=False, cache: typing.Optional[AnswerCache] = None,
+                 joins: typing.Optional[str] = None, engine: typing.Optional[Engine] = None,
+                 occurs_check='auto'):
+        self.engine = default_engine if engine is None else engine
+        self.occurs_check = occurs_check
         self.predicates: typing.List[Predicate] = []
+        self.index = ClauseIndex()
+        self.compiled = compiled
+        self.cache = cache
+        self.joins = joins
+        self.calls: typing.Dict[typing.Any, set] = {}
+        self.generation = 0
+        self.program_id = next(Prolog.program_ids)
+        self.relations: typing.Dict[typing.Any, Relation] = {}
+        self.builtins: typing.Dict[typing.Any, Builtin] = dict(BUILTINS)
+        self.foreign_predicates: typing.Dict[typing.Any, Foreign] = {}
+        self.tabled = set()
+        self.tables: typing.Dict[typing.Any, Table] = {}
+        self.table_stack: typing.List[Table] = []
+        self.table_pass = 0
+        self.answer_count = 0
+
+    @property
+    def store(self) -> 'Store':
+        return self.engine.store
+
+    def table(self, tag):
+        """Answer goals tagged with tag from tables of their call variants."""
+        self.tabled.add(('const', tag))
+
+    def builtin(self, tag, arity: int, function: typing.Callable[..., bool]):
+        """Runs goals tagged with tag by calling function, as for Builtin."""
+        self.check_undefined(('const', tag))
+        self.builtins[('const', tag)] = Builtin(tag, arity, function)
+        self.changed(('const', tag))
+
+    def foreign(self, tag, arity: int, function: typing.Callable[..., typing.Iterable[typing.Sequence]]):
+        """Answers goals tagged with tag from function, as for Foreign. With an
+        answer cache, call changed with ('const', tag) when its data changes."""
+        if ('const', tag) not in self.foreign_predicates:
+            self.define(('const', tag))
+            self.check_undefined(('const', tag))
+        self.foreign_predicates[('const', tag)] = Foreign(tag, arity, function)
+        self.changed(('const', tag))
+
+    def check_engine(self, handles: typing.Iterable[Handle]):
+        for handle in handles:
+            if handle.engine_ is not self.engine:
+                raise Exception("{} was made through another engine".format(handle))
+
+    def define(self, tag):
+        if tag in self.builtins:
+            raise Exception("{} is a builtin predicate".format(tag[1]))
+        if tag in self.foreign_predicates:
+            raise Exception("{} is a foreign predicate".format(tag[1]))
+
+    def check_undefined(self, tag):
+        if tag in self.relations or tag in self.index.primary or ('pair', tag) in self.index.primary:
+            raise Exception("{} already has clauses".format(tag[1]))
+
+    def native(self, goal: 'Value') -> bool:
+        tag = self.store.goal_tag(goal)
+        return tag in self.builtins or tag in self.foreign_predicates
+
+    def candidates(self, goal: 'Value') -> typing.Iterable[Predicate]:
+        """The clauses to try for goal, lazily produced answers (not a list)
+        for a foreign predicate."""
+        tag = self.store.goal_tag(goal)
+        builtin = self.builtins.get(tag)
+        if builtin is not None:
+            return [builtin]
+        if self.foreign_predicates:
+            foreign = self.foreign_predicates.get(tag)
+            if foreign is not None:
+                return foreign.answers(self.store, goal)
+        if self.tabled and tag in self.tabled:
+            return self.table_answers(goal)
+        return self.clauses(goal)
+
+    def clauses(self, goal: 'Value') -> typing.List[Predicate]:
+        candidates = self.index.candidates(self.store.value_index_key(goal))
+        if self.relations:
+            relation = self.relations.get(self.store.goal_tag(goal))
+            if relation is not None:
+                return relation.candidates(goal) + candidates
+        return candidates
+
+    def order_goals(self, goals: typing.List[Handle], bound: typing.Optional[set] = None) -> \
+            typing.List[Handle]:
+        """Greedily orders goals by estimated number of matching clauses, taking
+        the variables of goals already placed, and those in bound, as bound.
+
+        Builtin and foreign goals depend on what is bound when they run, so they
+        keep their places and only the goals between them are reordered."""
+        bound = set() if bound is None else set(bound)
+        pending = []
+        ordered = []
+        for handle in list(goals) + [None]:
+            goal = None if handle is None else self.store.get_item_or_ref(handle.ref_)
+            if goal is not None and not self.native(goal):
+                pending.append((handle, goal))
+                continue
+            while pending:
+                position = min(range(len(pending)),
+                               key=lambda n: (self.estimate(pending[n][1], bound), n))
+                placed, _ = pending.pop(position)
+                ordered.append(placed)
+                bound.update(placed.get_free_variables())
+            if handle is not None:
+                ordered.append(handle)
+                bound.update(handle.get_free_variables())
+        return ordered
+
+    def estimate(self, goal: 'Value', bound: set) -> float:
+        def is_bound(value):
+            value = self.store.deref(value)
+            return not isinstance(value, RefValue) or value.ref in bound
+
+        primary, first = self.store.value_index_key(goal)
+        if primary is None:
+            count = len(self.index.clauses)
+        else:
+            count = len(self.index.primary.get(primary, ())) + len(self.index.unindexed)
+        bucket = self.index.buckets.get(primary, {})
+        if count and first is not None and first[1] is None:
+            leaf = self.store.deref(goal)
+            for _ in range(first[0] + 1):
+                leaf = self.store.deref(leaf.car())
+            distinct = len(bucket) - (None in bucket)
+            if isinstance(leaf, RefValue) and leaf.ref in bound and distinct:
+                count /= distinct
+        elif count and primary is not None and first is not None:
+            count = len(bucket.get(ClauseIndex.bucket_key(first), ())) + len(bucket.get(None, ())) + \
+                len(self.index.unindexed)
+        relation = self.relations.get(self.store.goal_tag(goal))
+        if relation is not None and relation.size:
+            arguments = relation.arguments(goal)
+            rows = relation.size
+            for number, argument in enumerate(arguments or ()):
+                if is_bound(argument):
+                    index = relation.index(number)
+                    rows /= len(index) if index else 1
+            count += rows
+        return count
+
+    def table_answers(self, goal: 'Value') -> typing.List[Predicate]:
+        key = self.store.export(goal)
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = Table()
+        if not table.complete:
+            if table.depth is not None:
+                self.depend(table)
+            elif table.owner is None:
+                self.fill(table, key)
+            elif table.stamp == self.table_pass:
+                self.depend(table.owner)
+            else:
+                self.fill(table, key, once=True)
+        return list(table.answers)
+
+    def depend(self, table: Table):
+        for entry in self.table_stack[table.depth + 1:]:
+            entry.leader = min(entry.leader, table.depth)
+
+    def fill(self, table: Table, key, once=False):
+        """Evaluates a call variant until no table gets new answers (linear tabling).
+
+        A variant that calls back into one below it on the table stack only
+        completes together with it, when that leader reaches its fixpoint.
+        Until then it is owned by the table holding its component on the
+        stack and evaluated again, once, only after a leader started another
+        pass; in between calls get the answers found so far."""
+        depth = len(self.table_stack)
+        table.depth = table.leader = depth
+        table.scc.add(table)
+        self.table_stack.append(table)
+        goal = Handle(self.store.make_term(key), self.engine)
+        try:
+            while True:
+                count = self.answer_count
+                self.evaluate(table, goal)
+                if once or table.leader < depth or count == self.answer_count:
+                    break
+                self.table_pass += 1
+        finally:
+            self.table_stack.pop()
+            table.depth = None
+        if once:
+            table.leader = min(table.leader, table.owner.depth)
+        if table.leader == depth:
+            for entry in table.scc:
+                entry.complete = True
+        else:
+            parent = self.table_stack[-1]
+            parent.scc |= table.scc
+            parent.leader = min(parent.leader, table.leader)
+            for entry in table.scc:
+                entry.owner = parent
+            table.stamp = self.table_pass
+        table.scc = set()
+
+    def evaluate(self, table: Table, goal: Handle):
+        for predicate in self.clauses(self.store.get_item_or_ref(goal.ref_)):
+            point = self.store.push_choice()
+            try:
+                body = predicate.resolve(goal, self.occurs_check == 'strict')
+                if body is None:
+                    continue
+                solutions = self.search(body)
+                try:
+                    for _ in solutions:
+                        answer = self.store.export(self.store.get_item_or_ref(goal.ref_))
+                        if answer not in table.keys:
+                            table.keys.add(answer)
+                            table.answers.append(Fact(Handle(self.store.make_term(answer), self.engine)))
+                            self.answer_count += 1
+                finally:
+                    solutions.close()
+            finally:
+                self.store.pop_choice(point)
+
+    def add_predicate(self, predicate: Predicate):
+        tag = self.store.goal_tag(self.store.get_item_or_ref(predicate.head_handle().ref_))
+        self.define(tag)
+        self.predicates.append(predicate)
+        self.index.add(predicate)
+        if isinstance(predicate, HeadBody):
+            self.calls.setdefault(tag, set()).update(
+                self.store.goal_tag(self.store.get_item_or_ref(goal.ref_))
+                for goal in predicate.body.to_conjunction().handles)
+        self.changed(tag)
+
+    def relation(self, rows: typing.Iterable[typing.Sequence], tag):
+        """Adds ground facts stored column-wise in the relation for tag.
+
+        Their rows are tried before the ordinary clauses with the same tag."""
+        functor = ConstValue(tag).functor()
+        self.define(functor)
+        relation = self.relations.get(functor)
+        if relation is None:
+            relation = self.relations[functor] = Relation(tag, self.engine)
+        relation.extend(rows)
+        self.changed(functor)
+        return relation
+
+    def changed(self, tag):
+        self.tables.clear()
+        self.generation += 1
+        if self.cache is not None:
+            self.cache.invalidate(tag)
+
+    def dependencies(self, goals: typing.List['Value']) -> set:
+        tags = {self.store.goal_tag(goal) for goal in goals}
+        stack = list(tags)
+        while stack:
+            for tag in self.calls.get(stack.pop(), ()):
+                if tag not in tags:
+                    tags.add(tag)
+                    stack.append(tag)
+        return tags
 
     def fact(self, a):
-        self.predicates.append(Fact(a).with_new_free_variables())
+        self.check_engine([a])
+        self.add_predicate(Fact(a).with_new_free_variables())
+
+    def head_body(self, head, body, reorder=False):
+        """Adds a rule; with reorder its body goals run most selective first
+        instead of in the written order, which can change the solution order.
+
+        The interpreter orders the goals on every call, after unifying the head;
+        compiled code orders them once, as for a call with unbound arguments."""
+        self.check_engine([head] + body.to_conjunction().handles)
+        self.add_predicate(HeadBody(self, head, body, reorder).with_new_free_variables())
+
+    def load_facts(self, rows: typing.Iterable[typing.Sequence], tag):
+        """Adds a fact per row, with the row's items as arguments followed by tag.
+
+        Items are python constants or handles. Terms are built directly in the
+        store, only facts with variables are renamed, and the clause index is
+        extended once for the whole batch."""
+        store = self.store
+        tag_value = store.intern(ConstValue(tag))
+        self.define(tag_value.functor())
+        primary = ('pair', tag_value.functor()) if tag_value.functor() is not None else None
+        clauses = []
+        for row in rows:
+            value = first = None
+            consts = True
+            for item in row:
+                if isinstance(item, Handle):
+                    self.check_engine([item])
+                    item = store.get_item_or_ref(item.ref_)
+                    consts = False
+                else:
+                    item = store.intern(ConstValue(item))
+                if value is None:
+                    value = first = item
+                else:
+                    value = store.intern(PairValue(value, item))
+            if value is None:
+                value = tag_value
+                key = tag_value.functor(), None
+            else:
+                value = store.intern(PairValue(value, tag_value))
+                if consts:
+                    depth = len(row) - 1
+                    key = primary, ((depth, first.functor()) if depth <= INDEX_DEPTH
+                                    else (INDEX_DEPTH, 'pair'))
+            ref = store.next_ref.get()
+            store.items[ref] = value
+            fact = Fact(Handle(ref, self.engine))
+            if value.ground:
+                fact.free_vars = []
+            else:
+                fact = fact.with_new_free_variables()
+            if not consts:
+                key = fact.a.index_key()
+            clauses.append((key, fact))
+        self.predicates.extend(fact for _, fact in clauses)
+        self.index.extend(clauses)
+        self.changed(tag_value.functor())
+
+    def solutions(self, handle: typing.Union[Handle, HandleConjunction]):
+        self.store.maybe_collect()
+        full_con = handle.to_conjunction()
+        self.check_engine(full_con)
+        if self.cache is None or self.table_stack:
+            return self.search(full_con)
+        goals = [self.store.get_item_or_ref(goal.ref_) for goal in full_con.handles]
+        numbers = {}
+        key = self.program_id, tuple(self.store.export(goal, numbers) for goal in goals)
+        try:
+            answers = self.cache.get(key)
+        except TypeError:
+            return self.search(full_con)
+        if answers is None:
+            return self.caching_solutions(full_con, goals, key)
+        return self.cached_solutions(goals, answers)
+
+    def caching_solutions(self, con: HandleConjunction, goals: typing.List['Value'], key):
+        generation = self.generation
+        answers = []
+        solutions = self.search(con)
+        try:
+            for _ in solutions:
+                numbers = {}
+                answers.append(tuple(self.store.export(goal, numbers) for goal in goals))
+                yield
+        finally:
+            solutions.close()
+        if generation == self.generation:
+            self.cache.put(key, answers, self.dependencies(goals))
+
+    def cached_solutions(self, goals: typing.List['Value'], answers: list):
+        point = self.store.push_choice()
+        try:
+            for answer in answers:
+                mark = self.store.mark()
+                refs = {}
+                if all(self.store.unify_values(goal, self.store.build(term, refs))
+                       for goal, term in zip(goals, answer)):
+                    yield
+                self.store.undo(mark)
+        finally:
+            self.store.pop_choice(point)
+
+    def search(self, con: HandleConjunction):
+        if self.joins is not None:
+            plan = self.join_plan(con)
+            if plan is not None:
+                block, rest = plan
+                try:
+                    partials = self.join(block, self.joins == 'strict')
+                except TypeError:
+                    pass
+                else:
+                    return self.joined_solutions(partials, rest)
+        if self.compiled:
+            return Machine(self).solutions([self.store.get_item_or_ref(goal.ref_)
+                                            for goal in con.handles])
+        else:
+            return Solver(self).solutions(con)
+
+    def join_plan(self, con: HandleConjunction):
+        """Splits off the leading goals that only match rows of relations and
+        whose arguments are constants or variables."""
+        if self.index.unindexed:
+            return None
+        block = []
+        for handle in con.handles:
+            goal = self.store.get_item_or_ref(handle.ref_)
+            tag = self.store.goal_tag(goal)
+            relation = self.relations.get(tag)
+            if relation is None or not relation.arity or tag in self.tabled or \
+                    self.index.candidates(self.store.value_index_key(goal)):
+                break
+            arguments = relation.arguments(goal)
+            if arguments is None or any(isinstance(argument, PairValue) for argument in arguments):
+                break
+            block.append((relation, arguments))
+        if len(block) < 2:
+            return None
+        return block, HandleConjunction(con.handles[len(block):])
 
-    def head_body(self, head, body):
-        self.predicates.append(HeadBody(self, head, body).with_new_free_variables())
+    @staticmethod
+    def join(block, strict: bool) -> typing.List[typing.Dict[typing.Any, typing.Any]]:
+        """Hash joins the rows matching each goal of block on shared variables.
+
+        In strict mode goals are joined left to right, which keeps the order of
+        nested loop evaluation; otherwise the goal with the fewest matching rows
+        among those sharing a variable with the joined ones goes next."""
+        matches = [relation.select(arguments) for relation, arguments in block]
+        pending = list(range(len(block)))
+        partials = [{}]
+        while pending and partials:
+            if strict:
+                number = pending[0]
+            else:
+                joined = set(partials[0])
+                number = min(pending, key=lambda n: (
+                    not any(isinstance(argument, RefValue) and argument.ref in joined
+                            for argument in block[n][1]), len(matches[n])))
+            pending.remove(number)
+            relation, arguments = block[number]
+            shared = []
+            new = []
+            for column, argument in enumerate(arguments):
+                if isinstance(argument, RefValue):
+                    if argument.ref in partials[0]:
+                        shared.append((column, argument.ref))
+                    else:
+                        new.append((column, argument.ref))
+            columns = relation.columns
+            table = {}
+            for position in matches[number]:
+                key = tuple(columns[column][position] for column, _ in shared)
+                table.setdefault(key, []).append(position)
+            extended = []
+            for partial in partials:
+                for position in table.get(tuple(partial[ref] for _, ref in shared), ()):
+                    row = dict(partial)
+                    for column, ref in new:
+                        item = columns[column][position]
+                        if row.setdefault(ref, item) != item:
+                            break
+                    else:
+                        extended.append(row)
+            partials = extended
+        return partials
+
+    def joined_solutions(self, partials: typing.List[typing.Dict[typing.Any, typing.Any]],
+                         rest: HandleConjunction):
+        point = self.store.push_choice()
+        try:
+            for partial in partials:
+                mark = self.store.mark()
+                for ref, item in partial.items():
+                    self.store.bind(ref, self.store.intern(ConstValue(item)))
+                solutions = self.search(rest)
+                try:
+                    yield from solutions
+                finally:
+                    solutions.close()
+                self.store.undo(mark)
+        finally:
+            self.store.pop_choice(point)
 
     def go(self, handle: typing.Union[Handle, HandleConjunction], do: typing.Callable):
-        full_con = handle.to_conjunction()
+        solutions = self.solutions(handle)
+        try:
+            for _ in solutions:
+                do()
+        finally:
+            solutions.close()
+
+    def solve(self, query: typing.Union[Handle, HandleConjunction],
+              variables: typing.Optional[typing.Iterable[typing.Any]] = None):
+        """Yields the bindings of variables for each solution of query.
+
+        A search keeps its state on the store, so another search on the same
+        store can run to completion between two answers but can't be left
+        suspended there; resuming after that raises."""
+        handles = self.answer_variables(query, variables)
+        solutions = self.solutions(query)
+        try:
+            for _ in solutions:
+                answer = {name: self.store.python_value(self.store.get_item_or_ref(handle.ref_), Unbound)
+                          for name, handle in handles.items()}
+                suspended = self.store.mark(), self.store.depth
+                yield answer
+                if (self.store.mark(), self.store.depth) != suspended:
+                    raise Exception("another search changed the store while this one was suspended")
+        finally:
+            solutions.close()
+
+    def answer_variables(self, query: typing.Union[Handle, HandleConjunction],
+                         variables: typing.Optional[typing.Iterable[typing.Any]]) -> \
+            typing.Dict[typing.Any, Handle]:
+        if variables is None:
+            names = {ref: name for name, ref in self.store.variables.items()}
+            free_vars = query.to_conjunction().get_free_variables()
+            variables = [names[ref] for ref in dict.fromkeys(free_vars) if ref in names]
+        return {name: self.engine.V.make_variable(name) for name in variables}
+
+    def solve_parallel(self, query: typing.Union[Handle, HandleConjunction],
+                       variables: typing.Optional[typing.Iterable[typing.Any]] = None,
+                       workers: typing.Optional[int] = None, ordered=True):
+        """Like solve, but the alternatives for the first goal are explored by a
+        pool of worker processes, each loaded with a copy of the program.
+
+        With ordered the solutions come in the order solve gives them, otherwise
+        in the order the workers finish their share of the alternatives.
+        Programs with foreign predicates or builtins of their own are solved
+        here, since their functions cannot be sent to the workers, and so are
+        queries starting with a tabled goal, whose alternatives are only known
+        once its table is complete."""
+        con = query.to_conjunction()
+        handles = self.answer_variables(con, variables)
+        program = self.export_program()
+        if con.empty() or program['foreign'] or program['builtins'] or \
+                self.store.goal_tag(self.store.get_item_or_ref(con.head().ref_)) in self.tabled:
+            yield from self.solve(con, list(handles))
+            return
+        numbers = {}
+        goals = tuple(self.store.export(self.store.get_item_or_ref(goal.ref_), numbers)
+                      for goal in con)
+        targets = {name: self.store.export(self.store.get_item_or_ref(handle.ref_), numbers)
+                   for name, handle in handles.items()}
+        branches = len(self.candidates(self.store.get_item_or_ref(con.head().ref_)))
+        workers = workers or os.cpu_count() or 1
+        size = max(1, branches // (4 * workers))
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=start_worker,
+                initargs=(program,)) as executor:
+            futures = [executor.submit(solve_branches, goals, targets, start, start + size)
+                       for start in range(0, branches, size)]
+            if not ordered:
+                futures = concurrent.futures.as_completed(futures)
+            for future in futures:
+                yield from future.result()
+
+    def export_program(self):
+        """The clauses, relations and options of this program as plain picklable data.
+
+        Builtins and foreign predicates are only named: their functions may be
+        closures or hold live connections, so they are registered again with
+        builtin and foreign on the imported program."""
+        return {
+            'store': type(self.store),
+            'options': {'compiled': self.compiled, 'joins': self.joins,
+                        'occurs_check': self.occurs_check},
+            'clauses': [self.encode_clause(predicate) for predicate in self.predicates],
+            'relations': [(relation.tag.val, [relation.row(position) for position in range(relation.size)])
+                          for relation in self.relations.values()],
+            'tabled': [tag for _, tag in self.tabled],
+            'builtins': [(builtin.tag, builtin.arity)
+                         for key, builtin in self.builtins.items() if BUILTINS.get(key) is not builtin],
+            'foreign': [(foreign.tag.val, foreign.arity) for foreign in self.foreign_predicates.values()],
+        }
+
+    def encode_clause(self, predicate: Predicate):
+        if isinstance(predicate, StoredClause):
+            return predicate.data()
+        if isinstance(predicate, Fact):
+            return 'fact', self.store.export(self.store.get_item_or_ref(predicate.a.ref_))
+        if isinstance(predicate, HeadBody):
+            numbers = {}
+            head = self.store.export(self.store.get_item_or_ref(predicate.head.ref_), numbers)
+            body = tuple(self.store.export(self.store.get_item_or_ref(goal.ref_), numbers)
+                         for goal in predicate.body.to_conjunction())
+            return 'rule', head, body, predicate.reorder
+        raise Exception("cannot export {}".format(predicate))
+
+    def decode_clause(self, clause) -> Predicate:
+        if clause[0] == 'fact':
+            return Fact(Handle(self.store.make_term(clause[1]), self.engine))
+        _, head, body, reorder = clause
+        refs = {}
+        head = Handle(self.store.make_term(head, refs), self.engine)
+        body = HandleConjunction([Handle(self.store.make_term(goal, refs), self.engine) for goal in body])
+        return HeadBody(self, head, body, reorder)
 
-        if full_con.empty():
-            do()
-        else:
-            for item in self.predicates:
-                item.go(full_con.head(), lambda: self.go(full_con.tail(), do))
+    @staticmethod
+    def import_program(program, engine: typing.Optional[Engine] = None) -> 'Prolog':
+        """A program exported by export_program, made in engine or the default one."""
+        prolog = Prolog(engine=engine, **program['options'])
+        for clause in program['clauses']:
+            prolog.add_predicate(prolog.decode_clause(clause))
+        for tag, rows in program['relations']:
+            prolog.relation(rows, tag)
+        for tag in program['tabled']:
+            prolog.table(tag)
+        prolog.declare_natives(program)
+        return prolog
+
+    def declare_natives(self, program):
+        """Placeholders for the builtins and foreign predicates of an exported
+        program, which raise until registered again."""
+        for tag, arity in program['builtins']:
+            self.builtins[('const', tag)] = Builtin(tag, arity, None)
+        for tag, arity in program['foreign']:
+            self.foreign_predicates[('const', tag)] = Foreign(tag, arity, None)
+
+    def save(self, path):
+        """Writes the program to path as an image for load: a header with the
+        options, relations, clause index and calls, then each clause pickled on
+        its own. The image replaces path whole, so programs loaded from it keep
+        reading the old one."""
+        program = self.export_program()
+        blobs = [pickle.dumps(clause, pickle.HIGHEST_PROTOCOL) for clause in program['clauses']]
+        clauses = []
+        offset = 0
+        for (key, _), blob in zip(self.index.clauses, blobs):
+            clauses.append((key, offset, offset + len(blob)))
+            offset += len(blob)
+        header = pickle.dumps({
+            'options': program['options'],
+            'clauses': clauses,
+            'index': (self.index.primary, self.index.buckets, self.index.unindexed),
+            'calls': self.calls,
+            'relations': program['relations'],
+            'tabled': program['tabled'],
+            'builtins': program['builtins'],
+            'foreign': program['foreign'],
+        }, pickle.HIGHEST_PROTOCOL)
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(IMAGE_MAGIC)
+                file.write(struct.pack('<Q', len(header)))
+                file.write(header)
+                for blob in blobs:
+                    file.write(blob)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    @staticmethod
+    def load(path, engine: typing.Optional[Engine] = None) -> 'Prolog':
+        """A program saved to path, made in engine or the default one.
+
+        The file is mapped into memory and only the header is read; each clause
+        is decoded into the store when first tried. Images are pickles, so only
+        load trusted ones."""
+        with open(path, 'rb') as file:
+            image = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if image[:len(IMAGE_MAGIC)] != IMAGE_MAGIC:
+            raise Exception("{} is not a saved program".format(path))
+        size, = struct.unpack_from('<Q', image, len(IMAGE_MAGIC))
+        start = len(IMAGE_MAGIC) + 8
+        header = pickle.loads(image[start:start + size])
+        start += size
+        prolog = Prolog(engine=engine, **header['options'])
+        clauses = [(key, StoredClause(prolog, image, start + offset, start + end))
+                   for key, offset, end in header['clauses']]
+        prolog.predicates = [predicate for _, predicate in clauses]
+        prolog.index.clauses = clauses
+        prolog.index.primary, prolog.index.buckets, prolog.index.unindexed = header['index']
+        prolog.calls = header['calls']
+        for tag, rows in header['relations']:
+            prolog.relation(rows, tag)
+        for tag in header['tabled']:
+            prolog.table(tag)
+        prolog.declare_natives(header)
+        return prolog
 
     def __repr__(self):
         return "Prolog([{}])".format(", ".join(str(pred) for pred in self.predicates))
+
+
+worker_prolog: typing.Optional[Prolog] = None
+
+
+def start_worker(program):
+    global worker_prolog
+    worker_prolog = Prolog.import_program(program, Engine(program['store']()))
+
+
+def solve_branches(goals, targets, start, stop) -> typing.List[dict]:
+    """Solutions of the exported query goals that resolve the first goal with
+    its candidates from start to stop, in a worker started by start_worker."""
+    store = worker_prolog.store
+    refs = {}
+    con = HandleConjunction([Handle(store.make_term(goal, refs), worker_prolog.engine)
+                             for goal in goals])
+    values = {name: store.build(target, refs) for name, target in targets.items()}
+    first = con.head()
+    solutions = []
+    for predicate in worker_prolog.candidates(store.get_item_or_ref(first.ref_))[start:stop]:
+        point = store.push_choice()
+        try:
+            body = predicate.resolve(first, worker_prolog.occurs_check == 'strict')
+            if body is None:
+                continue
+            search = worker_prolog.search(HandleConjunction.link(body.prepend(con.goals[1])))
+            try:
+                for _ in search:
+                    solutions.append({name: store.python_value(value, Unbound)
+                                      for name, value in values.items()})
+            finally:
+                search.close()
+        finally:
+            store.pop_choice(point)
+    return solutions
@@ -1,6 +1,12 @@
+import itertools
+import os
+import shutil
+import tempfile
+import threading
 from unittest import TestCase
 
-from prolog import L, V, C, global_store, Prolog
+import prolog
+from prolog import L, V, C, global_store, Prolog, Store, ArrayStore, RefValue, ConstValue, Engine
 
 
 class TestOne(TestCase):
@@ -130,12 +136,155 @@ class TestOne(TestCase):
         x.go(y, do)
         self.assertEqual(w, [None])
 
+    def test_bindings_undone(self):
+        x = V.make_variable('x')
+        mark = global_store.mark()
+        w = []
+
+        def check():
+            self.assertEqual(x.value(), 5)
+            self.assertGreater(global_store.mark(), mark)
+            w.append(None)
+
+        x.go(C.make_const(5), check)
+        self.assertEqual(w, [None])
+        self.assertEqual(global_store.mark(), mark)
+        with self.assertRaises(Exception):
+            x.value()
+
+    def test_unify_keeps_store(self):
+        x = V.make_variable('x')
+        items = global_store.items
+        w = []
+
+        def check():
+            self.assertIs(prolog.global_store, global_store)
+            self.assertIs(global_store.items, items)
+            w.append(None)
+
+        x.make_const(1).go(C.make_const(2).make_const(1), check)
+        self.assertEqual(w, [None])
+
+    def test_long_lists(self):
+        x = V.make_variable('x')
+        n = 20000
+        m = L
+        k = x
+        for e in range(n):
+            m = m.make_const(e)
+            k = k.make_const(e)
+        w = []
+
+        def check():
+            value = m.value()
+            for e in reversed(range(n)):
+                self.assertEqual(value[1], e)
+                value = value[0]
+            self.assertEqual(value, None)
+            w.append(x.value())
+
+        m.go(k, check)
+        self.assertEqual(w, [None])
+
+
+class TestStore(TestCase):
+    store_class = Store
+
+    @staticmethod
+    def chain_length(store, ref):
+        length = 0
+        value = store.items.get(ref)
+        while isinstance(value, RefValue):
+            length += 1
+            value = store.items.get(value.ref)
+        return length
+
+    def test_alias_chain(self):
+        store = self.store_class()
+        refs = [store.make_variable(i) for i in range(100)]
+        mark = store.mark()
+        for a, b in zip(refs, refs[1:]):
+            self.assertTrue(store.unify_values(RefValue(a), RefValue(b)))
+        self.assertLessEqual(max(self.chain_length(store, ref) for ref in refs), 7)
+
+        self.assertTrue(store.unify_values(RefValue(refs[0]), ConstValue(7)))
+        self.assertEqual([store.value(ref) for ref in refs], [7] * 100)
+
+        store.undo(mark)
+        self.assertEqual(store.mark(), 0)
+        self.assertEqual(store.ranks, {})
+        for ref in refs:
+            with self.assertRaises(Exception):
+                store.value(ref)
+
+    def test_path_compression(self):
+        store = self.store_class()
+        a, b, c, d = (store.make_variable(name) for name in "abcd")
+        store.assign(store.items, a, RefValue(b))
+        store.assign(store.items, b, RefValue(c))
+        store.assign(store.items, c, RefValue(d))
+        mark = store.mark()
+        self.assertEqual(store.get_item_or_ref(a).ref, d)
+        self.assertEqual(self.chain_length(store, a), 1)
+        self.assertEqual(self.chain_length(store, b), 1)
+        store.undo(mark)
+        self.assertEqual(self.chain_length(store, a), 3)
+
+    def test_failed_unify_undoes_bindings(self):
+        store = self.store_class()
+        x, y = store.make_variable('x'), store.make_variable('y')
+        left = store.make_pair(store.make_pair(x, y), store.make_const(2))
+        right = store.make_pair(store.make_pair(store.make_const(1), x), store.make_const(3))
+        self.assertFalse(store.unify_values(store.get_item_or_ref(left), store.get_item_or_ref(right)))
+        self.assertEqual(store.mark(), 0)
+        self.assertIsInstance(store.get_item_or_ref(x), RefValue)
+        self.assertIsInstance(store.get_item_or_ref(y), RefValue)
+
+        right = store.make_pair(store.make_pair(store.make_const(1), x), store.make_const(2))
+        self.assertTrue(store.unify_values(store.get_item_or_ref(left), store.get_item_or_ref(right)))
+        self.assertEqual((store.value(x), store.value(y)), (1, 1))
+
+
+class TestArrayStore(TestStore):
+    store_class = ArrayStore
+
+    def test_cells(self):
+        store = ArrayStore()
+        x = store.make_variable('x')
+        inner = store.make_pair(store.make_const('a'), x)
+        term = store.make_pair(inner, store.make_const('a'))
+        heap = store.items
+        self.assertEqual(len(heap.constants), 2)
+        self.assertEqual(heap.tag(term), prolog.PAIR_CELL)
+        self.assertEqual(heap.payload(store.car(term)), heap.payload(inner))
+        self.assertEqual(store.value(store.cdr(term)), 'a')
+        self.assertTrue(store.unify_values(RefValue(x), store.get_item_or_ref(store.cdr(term))))
+        self.assertEqual(store.value(term), (('a', 'a'), 'a'))
+
+    def test_snapshot(self):
+        store = ArrayStore()
+        x = store.make_variable('x')
+        term = store.make_pair(x, store.make_const(1))
+        snapshot = store.snapshot()
+        self.assertTrue(store.unify_values(RefValue(x), store.get_item_or_ref(
+            store.make_pair(store.make_const(2), store.make_const(3)))))
+        self.assertEqual(store.value(term), ((2, 3), 1))
+        store.restore(snapshot)
+        self.assertEqual(store.next_ref.value, snapshot.next_ref)
+        self.assertNotIn(x, store.items)
+        self.assertEqual(store.value(store.cdr(term)), 1)
+
 
 class TestProlog(TestCase):
+    options = {}
+
+    def make_prolog(self):
+        return Prolog(**self.options)
+
     def test(self):
         x = V.make_variable('x')
         t = [1, 2, 3]
-        p = Prolog()
+        p = self.make_prolog()
         for e in t:
             p.fact(C.make_const(e))
         w = []
@@ -144,7 +293,7 @@ class TestProlog(TestCase):
 
     def test_and(self):
         w = 0
-        p = Prolog()
+        p = self.make_prolog()
         for e in [1, 2, 3]:
             p.fact(C.make_const(e))
 
@@ -157,7 +306,7 @@ class TestProlog(TestCase):
 
     def test_and_nested(self):
         w = 0
-        p = Prolog()
+        p = self.make_prolog()
         for e in [1, 2, 3]:
             p.fact(C.make_const(e))
 
@@ -171,7 +320,7 @@ class TestProlog(TestCase):
     def test_head_body_conjunction_warmup_warmup(self):
         x = V.make_variable("x")
         y = V.make_variable("y")
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(C.make_const(1).make_const('a'))
         p.fact(C.make_const(2).make_const('b'))
         w = 0
@@ -187,7 +336,7 @@ class TestProlog(TestCase):
     def test_head_body_conjunction_warmup_warmup_y_unassigned(self):
         x = V.make_variable("x")
         y = V.make_variable("y")
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(C.make_const(1).make_const('a'))
         p.fact(C.make_const(2).make_const('b'))
         w = 0
@@ -205,7 +354,7 @@ class TestProlog(TestCase):
     def test_head_body_conjunction_warmup(self):
         x = V.make_variable("x")
         y = V.make_variable("y")
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(C.make_const(1).make_const('a'))
         p.fact(C.make_const(2).make_const('b'))
         w = 0
@@ -222,7 +371,7 @@ class TestProlog(TestCase):
     def test_head_body_conjunction(self):
         x = V.make_variable("x")
         y = V.make_variable("y")
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(C.make_const(1).make_const('a'))
         p.fact(C.make_const(2).make_const('b'))
         p.head_body(x.pair(y).make_const('c'), x.make_const('a') & y.make_const('b'))
@@ -242,7 +391,7 @@ class TestProlog(TestCase):
         y = V.make_variable("y")
         z = V.make_variable("z")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -256,7 +405,7 @@ class TestProlog(TestCase):
         y = V.make_variable("y")
         z = V.make_variable("z")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -270,7 +419,7 @@ class TestProlog(TestCase):
         y = V.make_variable("y")
         z = V.make_variable("z")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -285,7 +434,7 @@ class TestProlog(TestCase):
         y = V.make_variable("y")
         z = V.make_variable("z")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -303,7 +452,7 @@ class TestProlog(TestCase):
         y = V.make_variable("y")
         z = V.make_variable("z")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -319,7 +468,7 @@ class TestProlog(TestCase):
     def test_instantiation_warmup(self):
         x = V.make_variable("x")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x)
         w = 0
 
@@ -333,7 +482,7 @@ class TestProlog(TestCase):
     def test_instantiation(self):
         x = V.make_variable("x")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x)
         w = 0
 
@@ -348,7 +497,7 @@ class TestProlog(TestCase):
         x = V.make_variable("x")
         y = V.make_variable("y")
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x)
         p.fact(y)
 
@@ -360,7 +509,7 @@ class TestProlog(TestCase):
 
     def test_conjunction(self):
         x = V.make_variable('x')
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(C.make_const(1).make_const("single"))
         p.fact(C.make_const(2).make_const("single"))
         p.head_body(x.pair(x).make_const("double"), x.make_const("single"))
@@ -386,7 +535,7 @@ class TestProlog(TestCase):
         y = V.make_variable('y')
         z = V.make_variable('z')
 
-        p = Prolog()
+        p = self.make_prolog()
         p.fact(x.pair(y.pair(x)).make_const("member"))
         p.head_body(x.pair(y.pair(z)).make_const("member"),
                     x.pair(y).make_const("member"))
@@ -421,3 +570,831 @@ class TestProlog(TestCase):
                  []
              ]
         )
+
+    def test_deep_recursion(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        n = 5000
+        p = self.make_prolog()
+        for e in range(n):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('next'))
+        p.fact(C.make_const(n).make_const('reach'))
+        p.head_body(x.make_const('reach'), x.pair(y).make_const('next') & y.make_const('reach'))
+
+        w = []
+        mark = prolog.global_store.mark()
+        p.go(C.make_const(0).make_const('reach'), lambda: w.append(prolog.global_store.mark() - mark))
+        self.assertEqual(len(w), 1)
+        self.assertLess(w[0], 10)
+
+    def test_solve(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = self.make_prolog()
+        p.fact(C.make_const(1).make_const('a'))
+        p.fact(C.make_const(2).make_const('a'))
+        p.fact(C.make_const(2).make_const('b'))
+        p.fact(C.make_const(3).pair(y).make_const('c'))
+
+        self.assertEqual(list(p.solve(x.make_const('a'), ['x'])), [{'x': 1}, {'x': 2}])
+        self.assertEqual(list(p.solve(x.make_const('a') & x.make_const('b'))), [{'x': 2}])
+        self.assertEqual(list(p.solve(C.make_const(1).make_const('a'))), [{}])
+        [solution] = p.solve(x.pair(y).make_const('c'))
+        self.assertEqual(solution['x'], 3)
+        self.assertIsInstance(solution['y'], prolog.Unbound)
+
+    def test_solve_lazily(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        p.fact(x.pair(y.pair(x)).make_const("member"))
+        p.head_body(x.pair(y.pair(z)).make_const("member"),
+                    x.pair(y).make_const("member"))
+        m = L
+        for e in range(100):
+            m = m.make_const(e)
+
+        mark = prolog.global_store.mark()
+        solutions = p.solve(x.pair(m).make_const("member"), ['x'])
+        self.assertEqual(next(solutions), {'x': 99})
+        self.assertEqual(list(itertools.islice(solutions, 2)), [{'x': 98}, {'x': 97}])
+        self.assertEqual(x.value(), 97)
+        solutions.close()
+        self.assertEqual(prolog.global_store.mark(), mark)
+        with self.assertRaises(Exception):
+            x.value()
+
+        nested = [(s['x'], len(list(p.solve(y.pair(m).make_const("member"), ['y']))))
+                  for s in itertools.islice(p.solve(x.pair(m).make_const("member"), ['x']), 2)]
+        self.assertEqual(nested, [(99, 100), (98, 100)])
+        first = p.solve(x.pair(m).make_const("member"), ['x'])
+        second = p.solve(y.pair(m).make_const("member"), ['y'])
+        with self.assertRaises(Exception):
+            list(zip(first, second))
+        with self.assertRaises(Exception):
+            next(second)
+        second.close()
+        self.assertEqual((prolog.global_store.mark(), prolog.global_store.depth), (mark, 0))
+        self.assertEqual(list(p.solve(x.pair(m).make_const("member"), ['x']))[:2], [{'x': 99}, {'x': 98}])
+
+    def test_tabling(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        p.table('path')
+        p.head_body(x.pair(y).make_const('path'),
+                    x.pair(z).make_const('path') & z.pair(y).make_const('edge'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('edge'))
+        for a, b in [(1, 2), (2, 3), (3, 1), (3, 4), (5, 6)]:
+            p.fact(C.make_const(a).make_const(b).make_const('edge'))
+
+        self.assertEqual(sorted(s['y'] for s in p.solve(C.make_const(1).pair(y).make_const('path'))),
+                         [1, 2, 3, 4])
+        self.assertEqual(len(list(p.solve(x.pair(y).make_const('path')))), 13)
+        self.assertEqual(list(p.solve(C.make_const(5).pair(y).make_const('path'))), [{'y': 6}])
+        self.assertTrue(all(table.complete for table in p.tables.values()))
+        tables = len(p.tables)
+        answers = len(p.tables[prolog.global_store.export(
+            prolog.global_store.get_item_or_ref(x.pair(y).make_const('path').ref_))].answers)
+        self.assertEqual(answers, 13)
+        self.assertEqual(len(list(p.solve(C.make_const(1).pair(y).make_const('path')))), 4)
+        self.assertEqual(len(p.tables), tables)
+
+    def test_tabling_mutual_recursion(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = self.make_prolog()
+        p.table('even')
+        p.table('odd')
+        p.fact(C.make_const(0).make_const('even'))
+        p.head_body(x.make_const('even'), y.make_const('odd') & y.pair(x).make_const('succ'))
+        p.head_body(x.make_const('odd'), y.make_const('even') & y.pair(x).make_const('succ'))
+        for e in range(6):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('succ'))
+        self.assertEqual(sorted(s['x'] for s in p.solve(x.make_const('even'))), [0, 2, 4, 6])
+        self.assertEqual(sorted(s['x'] for s in p.solve(x.make_const('odd'))), [1, 3, 5])
+
+    def test_tabling_double_recursion(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        p.table('path')
+        p.head_body(x.pair(y).make_const('path'),
+                    x.pair(z).make_const('path') & z.pair(y).make_const('path'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('edge'))
+        for a in range(12):
+            p.fact(C.make_const(a).make_const((a + 1) % 12).make_const('edge'))
+        evaluations = []
+        evaluate = p.evaluate
+        p.evaluate = lambda table, goal: evaluations.append(table) or evaluate(table, goal)
+
+        self.assertEqual(sorted(s['y'] for s in p.solve(C.make_const(0).pair(y).make_const('path'))),
+                         list(range(12)))
+        self.assertLess(len(evaluations), 12 * 12)
+        self.assertEqual(len(list(p.solve(x.pair(y).make_const('path')))), 144)
+        self.assertTrue(all(table.complete for table in p.tables.values()))
+
+    def test_answer_cache(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        cache = prolog.AnswerCache(max_entries=2)
+        p = Prolog(cache=cache, **self.options)
+        p.fact(C.make_const(1).make_const('a'))
+        p.fact(C.make_const(2).make_const('a'))
+        p.fact(C.make_const(1).make_const('b'))
+        p.head_body(x.make_const('r'), x.make_const('a'))
+
+        for _ in range(3):
+            self.assertEqual(list(p.solve(y.make_const('r'), ['y'])), [{'y': 1}, {'y': 2}])
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        p.fact(C.make_const(2).make_const('b'))
+        self.assertEqual(list(p.solve(y.make_const('r'), ['y'])), [{'y': 1}, {'y': 2}])
+        self.assertEqual(cache.hits, 3)
+        p.fact(C.make_const(3).make_const('a'))
+        self.assertEqual(list(p.solve(y.make_const('r'), ['y'])), [{'y': 1}, {'y': 2}, {'y': 3}])
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+        solutions = p.solve(x.make_const('b'), ['x'])
+        next(solutions)
+        solutions.close()
+        list(p.solve(x.make_const('b')))
+        list(p.solve(C.make_const(1).make_const('a')))
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.misses, 5)
+        list(p.solve(y.make_const('r')))
+        self.assertEqual(cache.misses, 6)
+
+        p.fact(x.pair(x).make_const('same'))
+        for item in (1, True, 1.0, True):
+            self.assertEqual([type(s['y']) for s in p.solve(C.make_const(item).pair(y).make_const('same'))],
+                             [type(item)])
+
+        p.cache = prolog.AnswerCache(max_bytes=1)
+        list(p.solve(y.make_const('r')))
+        self.assertEqual((len(p.cache.entries), p.cache.bytes), (0, 0))
+
+        shared = prolog.AnswerCache()
+        p.cache = shared
+        q = Prolog(cache=shared, **self.options)
+        q.fact(C.make_const(2).make_const('k'))
+        p.fact(C.make_const(1).make_const('k'))
+        self.assertEqual(list(p.solve(x.make_const('k'))), [{'x': 1}])
+        self.assertEqual(list(q.solve(x.make_const('k'))), [{'x': 2}])
+
+    def test_load_facts(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = self.make_prolog()
+        p.fact(C.make_const(0).make_const(0).make_const('next'))
+        p.load_facts(((e, e + 1) for e in range(1000)), tag='next')
+        p.load_facts([(5, x), (x, 7)], tag='next')
+        p.load_facts([('a',), ()], tag='flag')
+
+        solutions = list(p.solve(C.make_const(5).pair(y).make_const('next'), ['y']))
+        self.assertEqual(solutions[0], {'y': 6})
+        self.assertIsInstance(solutions[1]['y'], prolog.Unbound)
+        self.assertEqual(solutions[2], {'y': 7})
+        solutions = list(p.solve(x.pair(C.make_const(7)).make_const('next'), ['x']))
+        self.assertEqual(solutions[:2], [{'x': 6}, {'x': 5}])
+        self.assertIsInstance(solutions[2]['x'], prolog.Unbound)
+        self.assertEqual([s['x'] for s in p.solve(x.pair(y).make_const('next'), ['x'])][:3], [0, 0, 1])
+        self.assertEqual(list(p.solve(x.make_const('flag'), ['x'])), [{'x': 'a'}])
+        self.assertEqual(list(p.solve(C.make_const('flag'))), [{}])
+        self.assertEqual(len(p.predicates), 1005)
+
+    def test_relation(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        rows = [(e % 10, e, 'n{}'.format(e % 3)) for e in range(300)]
+        p = self.make_prolog()
+        q = self.make_prolog()
+        p.relation(rows, tag='r')
+        q.load_facts(rows, tag='r')
+
+        def goal(*arguments):
+            term = None
+            for number, argument in enumerate(arguments):
+                argument = C.make_const(argument) if argument is not None else V.make_variable(
+                    'a{}'.format(number))
+                term = argument if term is None else term.pair(argument)
+            return term.make_const('r')
+
+        for arguments in [(3, None, 'n0'), (None, 42, None), (1, 1, 'n1'), (1, 2, 'n1')]:
+            self.assertEqual(list(p.solve(goal(*arguments))), list(q.solve(goal(*arguments))))
+        self.assertEqual(len(list(p.solve(x.pair(y).make_const('r')))), 300)
+        self.assertEqual(len(list(p.solve(x.make_const('r')))), 300)
+        self.assertEqual(len(list(p.solve(C.make_const(1).make_const('r')))), 0)
+        self.assertEqual(len(p.relations[('const', 'r')].candidates(
+            prolog.global_store.get_item_or_ref(goal(3, None, 'n0').ref_))), 10)
+        with self.assertRaises(Exception):
+            p.relation([(1, 2)], tag='r')
+
+    def test_joins(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        programs = [Prolog(joins=joins, **self.options) for joins in (None, 'strict', 'any')]
+        for p in programs:
+            p.relation([(e % 7, e) for e in range(50)], tag='a')
+            p.relation([(e, e % 5, 'b') for e in range(0, 50, 2)] * 2, tag='b')
+            p.relation([(e,) for e in range(3)], tag='c')
+            p.fact(C.make_const(4).make_const('d'))
+        query = x.pair(y).make_const('a') & y.pair(z).make_const('b').make_const('b') & \
+            z.make_const('c') & z.make_const('d')
+        self.assertIsNotNone(programs[1].join_plan(query))
+        plain, strict, unordered = (list(p.solve(query)) for p in programs)
+        self.assertEqual(strict, plain)
+        self.assertEqual(sorted(map(sorted, map(dict.items, unordered))),
+                         sorted(map(sorted, map(dict.items, plain))))
+        query = x.pair(y).make_const('a') & y.pair(z).make_const('b').make_const('b') & \
+            z.make_const('c')
+        plain, strict, unordered = (list(p.solve(query)) for p in programs)
+        self.assertEqual(len(plain), 30)
+        self.assertEqual(strict, plain)
+        self.assertEqual(sorted(map(sorted, map(dict.items, unordered))),
+                         sorted(map(sorted, map(dict.items, plain))))
+        query = x.pair(x).make_const('a') & x.pair(y).make_const('b').make_const('b')
+        plain, strict, unordered = (list(p.solve(query)) for p in programs)
+        self.assertEqual(strict, plain)
+        self.assertEqual(len(unordered), len(plain))
+
+    def test_reorder(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        p.relation([(e, e % 50) for e in range(500)], tag='big')
+        for e in range(200):
+            p.fact(C.make_const(e).make_const(e * 2).make_const('medium'))
+        p.fact(C.make_const(7).make_const('small'))
+        body = x.pair(y).make_const('big') & y.pair(z).make_const('medium') & y.make_const('small')
+        p.head_body(x.pair(z).make_const('r'), body)
+        p.head_body(x.pair(z).make_const('s'), body, reorder=True)
+
+        self.assertEqual([goal.index_key()[0][1] for goal in p.order_goals(body.handles)],
+                         [('const', 'small'), ('const', 'medium'), ('const', 'big')])
+        expected = sorted(s['x'] for s in p.solve(x.pair(z).make_const('r')))
+        self.assertEqual(len(expected), 10)
+        self.assertEqual(sorted(s['x'] for s in p.solve(x.pair(z).make_const('s'))), expected)
+        self.assertEqual(list(p.solve(C.make_const(57).pair(z).make_const('s'))), [{'z': 14}])
+
+        p.fact(C.make_const([1]).make_const('u'))
+        p.head_body(x.make_const('t'), x.make_const('small') & C.make_const([1]).make_const('u'),
+                    reorder=True)
+        self.assertEqual(list(p.solve(x.make_const('t'))), [{'x': 7}])
+        goal = C.make_const(3).make_const(6).make_const('medium')
+        self.assertEqual(p.estimate(p.store.get_item_or_ref(goal.ref_), set()), 1)
+
+    def test_solve_parallel(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        for e in range(12):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('next'))
+        p.relation([(e, e * e) for e in range(14)], tag='square')
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(z).make_const('next') &
+                    z.pair(y).make_const('path'))
+        p.table('path')
+        w = V.make_variable('w')
+        query = x.pair(w).make_const('next') & w.pair(y).make_const('path') & y.pair(z).make_const('square')
+        expected = list(p.solve(query))
+        self.assertEqual(len(expected), 66)
+        self.assertEqual(list(p.solve_parallel(query, workers=2)), expected)
+        tabled = x.pair(y).make_const('path') & y.pair(z).make_const('square')
+        self.assertEqual(list(p.solve_parallel(tabled, workers=2)), list(p.solve(tabled)))
+        key = lambda solution: sorted(solution.items())
+        self.assertEqual(sorted(p.solve_parallel(query, ['z', 'x'], workers=3, ordered=False), key=key),
+                         sorted(p.solve(query, ['z', 'x']), key=key))
+
+    def test_occurs_check_modes(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        for mode in ('auto', 'strict'):
+            p = self.make_prolog()
+            p.occurs_check = mode
+            p.fact(x.pair(x).make_const('same'))
+            p.fact(x.pair(y).make_const('any'))
+            p.head_body(x.make_const('wrap'), x.pair(L.pair(x)).make_const('same'))
+            self.assertEqual(list(p.solve(y.pair(L.pair(y)).make_const('same'))), [])
+            self.assertEqual(list(p.solve(y.make_const('wrap'))), [])
+            self.assertEqual(list(p.solve(C.make_const(1).pair(y).make_const('same'))), [{'y': 1}])
+            self.assertEqual(len(list(p.solve(y.pair(L.pair(y)).make_const('any')))), 1)
+            repeats = [predicate.linear_head and len(predicate.linear_head[1]) for predicate in p.predicates]
+            self.assertEqual(repeats, [None, None, None] if mode == 'strict' or p.compiled else [1, 0, 0])
+
+    def test_builtins(self):
+        n = V.make_variable('n')
+        m = V.make_variable('m')
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+
+        def op(left, right, name):
+            return left.pair(right).make_const(name)
+
+        p = self.make_prolog()
+        p.fact(C.make_const(0).make_const('count'))
+        p.head_body(n.make_const('count'), op(n, C.make_const(0), '>') &
+                    op(m, op(n, C.make_const(1), '-'), 'is') & m.make_const('count'))
+        self.assertEqual(list(p.solve(C.make_const(500).make_const('count'))), [{}])
+        self.assertEqual(list(p.solve(C.make_const(-1).make_const('count'))), [])
+
+        p.load_facts([(e,) for e in range(10)], 'digit')
+        query = x.make_const('digit') & op(y, op(op(x, x, '*'), C.make_const(2), 'mod'), 'is') & \
+            op(y, C.make_const(0), '=:=') & op(x, C.make_const(5), '>=')
+        self.assertEqual([s['x'] for s in p.solve(query)], [6, 8])
+        self.assertEqual(list(p.solve(op(x, op(C.make_const(7), C.make_const(2), '//'), 'is') &
+                                      op(y, x.make_const('abs'), 'is'))), [{'x': 3, 'y': 3}])
+        self.assertEqual(list(p.solve(x.make_const('var') & C.make_const('a').make_const('atomic') &
+                                      L.pair(L).make_const('nonvar'), ['x'])), [{'x': prolog.Unbound(x.ref_)}])
+        self.assertEqual(list(p.solve(L.pair(L).make_const('atomic'))), [])
+        with self.assertRaises(Exception):
+            list(p.solve(op(x, op(y, C.make_const(1), '+'), 'is')))
+        with self.assertRaises(Exception):
+            p.fact(C.make_const(1).make_const('var'))
+        with self.assertRaises(Exception):
+            p.builtin('digit', 1, lambda store, value: True)
+        with self.assertRaises(Exception):
+            list(p.solve(op(x, C.make_const(1).pair(C.make_const(1).pair(C.make_const(2))), 'is')))
+
+        p.builtin('even', 1, lambda store, value: isinstance(value, ConstValue) and value.val % 2 == 0)
+        self.assertEqual([s['x'] for s in p.solve(x.make_const('digit') & x.make_const('even'))],
+                         [0, 2, 4, 6, 8])
+        p.builtin('yes', 0, lambda store: True)
+        p.builtin('no', 0, lambda store: False)
+        self.assertEqual(list(p.solve(C.make_const('yes'))), [{}])
+        self.assertEqual(list(p.solve(x.make_const('digit') & C.make_const('no'))), [])
+
+        goals = [op(x, C.make_const(1), '>'), x.make_const('digit'), op(y, x, 'is'), y.make_const('count')]
+        self.assertEqual(p.order_goals(goals), [goals[0], goals[1], goals[2], goals[3]])
+        self.assertEqual(p.order_goals(goals[1:2] + goals[3:] + goals[2:3]), [goals[3], goals[1], goals[2]])
+
+    def test_foreign(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        ages = {'ann': 31, 'bob': 17, 'cid': 45}
+        pulled = []
+
+        def age(name, years):
+            for key, value in ages.items():
+                if isinstance(name, prolog.Unbound) or name == key:
+                    pulled.append(key)
+                    yield key, value
+
+        def numbers(start, number):
+            count = start
+            while True:
+                yield start, count
+                count += 1
+
+        p = self.make_prolog()
+        p.foreign('age', 2, age)
+        p.foreign('from', 2, numbers)
+        p.head_body(x.make_const('adult'), x.pair(y).make_const('age') &
+                    y.pair(C.make_const(18)).make_const('>='))
+        self.assertEqual(list(p.solve(x.make_const('adult'))), [{'x': 'ann'}, {'x': 'cid'}])
+        self.assertEqual(list(p.solve(C.make_const('bob').pair(y).make_const('age'))), [{'y': 17}])
+        self.assertEqual(list(p.solve(C.make_const('bob').pair(C.make_const(18)).make_const('age'))), [])
+
+        pulled.clear()
+        self.assertEqual(next(p.solve(x.pair(y).make_const('age'))), {'x': 'ann', 'y': 31})
+        self.assertLessEqual(len(pulled), 2)
+        query = C.make_const(5).pair(x).make_const('from') & \
+            x.pair(C.make_const(3)).make_const('*').pair(C.make_const(20)).make_const('>')
+        self.assertEqual(next(p.solve(query)), {'x': 7})
+        self.assertEqual(list(p.solve(x.pair(z).make_const('age') & z.make_const('var'))), [])
+
+        p.foreign('echo', 2, lambda first, second: [(first, first)])
+        self.assertEqual(list(p.solve(x.pair(y).make_const('echo') & C.make_const(1).pair(y).make_const('echo'),
+                                      ['x', 'y'])), [{'x': 1, 'y': 1}])
+        pair = C.make_const(1).pair(C.make_const(2))
+        self.assertEqual(list(p.solve(pair.pair(pair).make_const('echo'))), [{}])
+        self.assertEqual(list(p.solve(pair.pair(y).make_const('echo'), ['y'])), [{'y': (1, 2)}])
+        self.assertEqual(list(p.solve(pair.pair(C.make_const(1).pair(C.make_const(3))).make_const('echo'))), [])
+        p.foreign('one', 0, lambda: [()])
+        p.foreign('none', 0, lambda: [])
+        self.assertEqual(list(p.solve(C.make_const('one'))), [{}])
+        self.assertEqual(list(p.solve(C.make_const('one') & C.make_const('none'))), [])
+        p.foreign('short', 2, lambda first, second: [(first,)])
+        with self.assertRaises(Exception):
+            list(p.solve(x.pair(y).make_const('short')))
+        with self.assertRaises(Exception):
+            p.fact(C.make_const(1).pair(C.make_const(2)).make_const('age'))
+
+        p.builtin('teen', 1, lambda store, value: 13 <= value.val <= 19)
+        p.head_body(x.make_const('young'), x.pair(y).make_const('age') & y.make_const('teen'))
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            p.save(path)
+            loaded = Prolog.load(path)
+        finally:
+            os.remove(path)
+        with self.assertRaises(Exception):
+            list(loaded.solve(x.make_const('young')))
+        loaded.foreign('age', 2, age)
+        with self.assertRaises(Exception):
+            list(loaded.solve(x.make_const('young')))
+        loaded.builtin('teen', 1, lambda store, value: 13 <= value.val <= 19)
+        self.assertEqual(list(loaded.solve(x.make_const('young'))), [{'x': 'bob'}])
+
+    def test_occurs_checks_for_append(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        w = V.make_variable('w')
+        items = L
+        for e in range(40):
+            items = C.make_const(e).pair(items)
+        counts = {}
+        store = prolog.global_store
+        occurs = store.occurs
+
+        def counting_occurs(ref, value):
+            counts[mode] += 1
+            return occurs(ref, value)
+
+        store.occurs = counting_occurs
+        try:
+            for mode in ('auto', 'strict'):
+                counts[mode] = 0
+                p = self.make_prolog()
+                p.occurs_check = mode
+                p.fact(L.pair(x).pair(x).make_const('app'))
+                p.head_body(x.pair(y).pair(z).pair(x.pair(w)).make_const('app'),
+                            y.pair(z).pair(w).make_const('app'))
+                query = items.pair(items).pair(z).make_const('app')
+                self.assertEqual(len(list(p.solve(query))), 1)
+                self.assertEqual(len(list(p.solve(x.pair(y).pair(items).make_const('app')))), 41)
+        finally:
+            del store.occurs
+        self.assertGreater(counts['strict'], 80)
+        self.assertEqual(counts['auto'], counts['strict'] if p.compiled else 0)
+
+    def test_save_load(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        for e in range(6):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('next'))
+        p.fact(x.pair(x).make_const('same'))
+        p.relation([(e, e * e) for e in range(8)], tag='square')
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(z).make_const('path') &
+                    z.pair(y).make_const('next'))
+        p.table('path')
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            p.save(path)
+            loaded = Prolog.load(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(len(loaded.predicates), len(p.predicates))
+        self.assertTrue(all(predicate.decoded is None for predicate in loaded.predicates))
+        query = C.make_const(2).pair(y).make_const('path') & y.pair(z).make_const('square')
+        self.assertEqual(list(loaded.solve(query)), list(p.solve(query)))
+        self.assertEqual(list(loaded.solve(C.make_const(4).pair(y).make_const('same'))), [{'y': 4}])
+        self.assertTrue(all(predicate.decoded is None for predicate in loaded.predicates[:2]))
+        self.assertEqual(loaded.export_program(), p.export_program())
+
+    def test_save_over_loaded(self):
+        y = V.make_variable('y')
+        p = self.make_prolog()
+        for e in range(6):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('next'))
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'image')
+        try:
+            p.save(path)
+            loaded = Prolog.load(path)
+            loaded.fact(C.make_const(6).make_const(7).make_const('next'))
+            loaded.save(path)
+            program = loaded.export_program()
+            self.assertEqual(len(program['clauses']), 7)
+            reloaded = Prolog.load(path)
+            self.assertEqual(reloaded.export_program(), program)
+            self.assertEqual(list(reloaded.solve(C.make_const(6).pair(y).make_const('next'))), [{'y': 7}])
+            self.assertEqual(os.listdir(directory), ['image'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestCompiledProlog(TestProlog):
+    options = {'compiled': True}
+
+    def test_compile(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = self.make_prolog()
+        p.head_body(x.pair(x).make_const('double'), x.pair(y).make_const('single'))
+        self.assertEqual([op for op, arg in p.predicates[0].compile().code],
+                         [prolog.GET_PAIR, prolog.GET_PAIR, prolog.UNIFY_VAR, prolog.UNIFY_VAL,
+                          prolog.GET_CONST, prolog.PUT_VAL, prolog.PUT_VAR, prolog.PUT_PAIR,
+                          prolog.PUT_TERM, prolog.PUT_PAIR, prolog.EXECUTE])
+
+    def test_compile_trims_environment(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = self.make_prolog()
+        p.head_body(x.pair(z).make_const('r'),
+                    x.pair(y).make_const('a') & y.make_const('b') & z.make_const('c'))
+        calls = [(op, arg) for op, arg in p.predicates[0].compile().code
+                 if op in (prolog.CALL, prolog.EXECUTE)]
+        self.assertEqual(calls, [(prolog.CALL, (0,)), (prolog.CALL, (2,)), (prolog.EXECUTE, None)])
+
+
+class TestArrayStoreProlog(TestProlog):
+    def setUp(self):
+        self.previous = prolog.use_store(ArrayStore())
+
+    def tearDown(self):
+        prolog.use_store(self.previous)
+
+
+class TestGarbageCollection(TestCase):
+    store_class = Store
+
+    def setUp(self):
+        self.previous = prolog.use_store(self.store_class())
+        self.store = prolog.global_store
+
+    def tearDown(self):
+        prolog.use_store(self.previous)
+
+    def test_collect(self):
+        t = C.make_const(1).make_const(2).make_const('t')
+        for _ in range(100):
+            t.car().cdr().value()
+        before = len(self.store.items)
+        self.store.collect()
+        self.assertLess(len(self.store.items), before - 100)
+        self.assertEqual(t.value(), ((1, 2), 't'))
+        self.assertIsNone(L.value())
+
+    def test_collect_during_search(self):
+        x = V.make_variable('x')
+        p = Prolog()
+        p.fact(C.make_const(1).make_const(2).make_const('t'))
+        w = []
+
+        def check():
+            self.store.collect()
+            w.append(x.value())
+        p.go(x.make_const('t'), check)
+        self.assertEqual(w, [(1, 2)])
+        with self.assertRaises(Exception):
+            x.value()
+
+    def test_threshold(self):
+        self.store.gc_threshold = 1000
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = Prolog()
+        for e in range(20):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(V.make_variable('z')).make_const('next') &
+                    V.make_variable('z').pair(y).make_const('path'))
+        sizes = []
+        for _ in range(30):
+            self.assertEqual(len(list(p.solve(C.make_const(0).pair(y).make_const('path')))), 20)
+            sizes.append(self.heap_size())
+        self.assertLess(max(sizes), min(sizes) + 3 * self.store.gc_threshold)
+
+    def test_collect_during_deterministic_loop(self):
+        self.store.gc_threshold = 500
+        n = V.make_variable('n')
+        m = V.make_variable('m')
+        for compiled in (False, True):
+            p = Prolog(compiled=compiled)
+            sizes = []
+            p.builtin('probe', 0, lambda store: sizes.append(len(store.items)) or True)
+            p.fact(C.make_const(0).make_const('count'))
+            p.head_body(n.make_const('count'), n.pair(C.make_const(0)).make_const('>') & C.make_const('probe') &
+                        m.pair(n.pair(C.make_const(1)).make_const('-')).make_const('is') & m.make_const('count'))
+            self.assertEqual(list(p.solve(C.make_const(4000).make_const('count'))), [{}])
+            self.assertLessEqual(max(sizes[2000:]), max(sizes[:2000]))
+
+    def test_sweep_interned(self):
+        self.store.hash_consing = True
+        kept = C.make_const('kept').pair(C.make_const(0))
+        size = self.heap_size()
+        for e in range(1000):
+            C.make_const(e).pair(C.make_const('dropped'))
+        self.store.collect()
+        self.assertLess(len(self.store.interned), 10)
+        self.assertLessEqual(self.heap_size(), size)
+        self.assertEqual(kept.value(), ('kept', 0))
+        self.assertEqual(C.make_const(5).pair(C.make_const('dropped')).value(), (5, 'dropped'))
+
+    def heap_size(self):
+        return len(self.store.items)
+
+
+class TestArrayStoreGarbageCollection(TestGarbageCollection):
+    store_class = ArrayStore
+
+    def heap_size(self):
+        return self.store.items.capacity() + len(self.store.items.constants)
+
+
+class TestEngine(TestCase):
+    @staticmethod
+    def make_path(engine, length):
+        x = engine.V.make_variable('x')
+        y = engine.V.make_variable('y')
+        z = engine.V.make_variable('z')
+        p = engine.prolog()
+        for e in range(length):
+            p.fact(engine.C.make_const(e).make_const(e + 1).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(y).make_const('next'))
+        p.head_body(x.pair(y).make_const('path'), x.pair(z).make_const('next') &
+                    z.pair(y).make_const('path'))
+        return p, engine.C.make_const(0).pair(y).make_const('path')
+
+    def test_separate_stores(self):
+        first = Engine()
+        second = Engine(ArrayStore())
+        p, query = self.make_path(first, 3)
+        q, other = self.make_path(second, 5)
+        self.assertIsNot(first.store, global_store)
+        self.assertIs(p.store, first.store)
+        self.assertEqual([s['y'] for s in p.solve(query)], [1, 2, 3])
+        self.assertEqual([s['y'] for s in q.solve(other)], [1, 2, 3, 4, 5])
+        self.assertEqual(first.L.make_const(3).cdr().value(), 3)
+        self.assertIs(C.make_const(1).engine_, prolog.default_engine)
+        self.assertEqual(list(Prolog().solve(V.make_variable('y').make_const('path'))), [])
+
+    def test_engines_do_not_mix(self):
+        engine = Engine()
+        p, query = self.make_path(engine, 3)
+        with self.assertRaises(Exception):
+            engine.C.make_const(1).pair(C.make_const('x'))
+        with self.assertRaises(Exception):
+            engine.C.make_const(1).unify(C.make_const(1))
+        with self.assertRaises(Exception):
+            p.fact(C.make_const(1).make_const('a'))
+        with self.assertRaises(Exception):
+            p.head_body(engine.C.make_const('b'), C.make_const(1).make_const('a'))
+        with self.assertRaises(Exception):
+            p.load_facts([(C.make_const(1),)], 'a')
+        with self.assertRaises(Exception):
+            list(p.solve(query & C.make_const(1).make_const('a')))
+        self.assertEqual(len(list(p.solve(query))), 3)
+
+    def test_threads(self):
+        results = {}
+
+        def run(length):
+            engine = Engine()
+            p, query = self.make_path(engine, length)
+            results[length] = [[s['y'] for s in p.solve(query)] for _ in range(20)]
+
+        threads = [threading.Thread(target=run, args=(length,)) for length in range(5, 13)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {length: [list(range(1, length + 1))] * 20
+                                   for length in range(5, 13)})
+
+
+class TestIndex(TestCase):
+    def test_tag(self):
+        x = V.make_variable('x')
+        p = Prolog()
+        for e in range(100):
+            p.fact(C.make_const(e).make_const('a'))
+            p.fact(C.make_const(e).make_const('b'))
+        candidates = p.index.candidates(x.make_const('a').index_key())
+        self.assertEqual(len(candidates), 100)
+
+    def test_first_argument(self):
+        x = V.make_variable('x')
+        p = Prolog()
+        for e in range(1000):
+            p.fact(C.make_const(e).make_const(e + 1).make_const('succ'))
+        self.assertEqual(len(p.index.candidates(C.make_const(5).pair(x).make_const('succ').index_key())), 1)
+        self.assertEqual(len(p.index.candidates(x.make_const(6).make_const('succ').index_key())), 1000)
+
+        w = []
+        p.go(C.make_const(5).pair(x).make_const('succ'), lambda: w.append(x.value()))
+        self.assertEqual(w, [6])
+
+    def test_order_with_unindexed(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        p = Prolog()
+        p.fact(C.make_const(1).make_const('a'))
+        p.fact(x)
+        p.fact(C.make_const(2).make_const('b'))
+        p.fact(x.pair(y))
+        p.fact(C.make_const(3).make_const('a'))
+        candidates = p.index.candidates(y.make_const('a').index_key())
+        self.assertEqual(candidates, [p.predicates[i] for i in [0, 1, 3, 4]])
+
+    def test_shape_mismatch(self):
+        x = V.make_variable('x')
+        y = V.make_variable('y')
+        z = V.make_variable('z')
+        p = Prolog()
+        p.fact(x.pair(y.pair(x)).make_const("member"))
+        p.head_body(x.pair(y.pair(z)).make_const("member"),
+                    x.pair(y).make_const("member"))
+        self.assertEqual(p.index.candidates(L.pair(x).make_const("member").index_key()),
+                         p.predicates)
+        self.assertEqual(p.index.candidates(C.make_const(1).make_const("member").index_key()),
+                         [])
+
+    def test_failed_attempts_do_not_rename(self):
+        x = V.make_variable('x')
+        p = Prolog()
+        for e in range(1000):
+            p.fact(C.make_const(1).make_const(e).make_const('t'))
+        p.head_body(C.make_const(2).pair(x).make_const("t"), x)
+
+        w = []
+        before = global_store.next_ref.value
+        p.go(C.make_const(1).make_const(500).make_const('t'), lambda: w.append(None))
+        self.assertEqual(w, [None])
+        self.assertLess(global_store.next_ref.value - before, 20)
+
+
+class TestTerms(TestCase):
+    def test_slots(self):
+        for value in (ConstValue(1), RefValue(1), prolog.PairValue(ConstValue(1), RefValue(1))):
+            with self.assertRaises(AttributeError):
+                value.__dict__
+
+    def test_ground(self):
+        self.assertTrue(prolog.PairValue(ConstValue(1), ConstValue(2)).ground)
+        self.assertFalse(prolog.PairValue(ConstValue(1), RefValue(2)).ground)
+
+    def test_rename_shares_unchanged_subterms(self):
+        store = Store()
+        x = store.make_variable('x')
+        ground = store.make_pair(store.make_const(1), store.make_const(2))
+        term = store.make_pair(ground, x)
+        renamed = store.get_item_or_ref(store.substitute_ref(term, [(x, 100)]))
+        self.assertIs(renamed.car(), store.get_item_or_ref(ground))
+        self.assertEqual(renamed.cdr().ref, 100)
+        self.assertIs(store.get_item_or_ref(store.substitute_ref(ground, [(x, 100)])),
+                      store.get_item_or_ref(ground))
+
+    def test_hash_consing(self):
+        store = Store(hash_consing=True)
+        refs = [store.make_pair(store.make_pair(store.make_const(1), store.make_const('a')),
+                                store.make_const('edge'))
+                for _ in range(3)]
+        values = [store.get_item_or_ref(ref) for ref in refs]
+        self.assertIs(values[0], values[1])
+        self.assertIs(values[0], values[2])
+        self.assertIsNot(store.get_item_or_ref(store.make_const(1)),
+                         store.get_item_or_ref(store.make_const(1.0)))
+        x = store.make_variable('x')
+        self.assertIsNot(store.get_item_or_ref(store.make_pair(x, store.make_const(1))),
+                         store.get_item_or_ref(store.make_pair(x, store.make_const(1))))
+        plain = Store()
+        self.assertIsNot(plain.get_item_or_ref(plain.make_const(1)),
+                         plain.get_item_or_ref(plain.make_const(1)))
+
+    def test_conjunction_shares_structure(self):
+        x = V.make_variable('x')
+        goals = [x.make_const('a')] + [C.make_const(e).make_const('b') for e in range(5)]
+        con = goals[0] & goals[1]
+        for goal in goals[2:]:
+            con = con & goal
+        self.assertEqual(con.handles, goals)
+        self.assertIs(con.tail().goals, con.goals[1])
+        self.assertEqual(con.tail().tail().head(), goals[2])
+        renamed = con.substitute([(x.ref_, prolog.global_store.make_variable('renamed'))])
+        self.assertNotEqual(renamed.head(), goals[0])
+        self.assertIs(renamed.goals[1], con.goals[1])
+        self.assertIs(con.substitute([]).goals, con.goals)
+
+    def test_conjunction_joins_lazily(self):
+        goals = [C.make_const(e).make_const('b') for e in range(20000)]
+        con = goals[0].to_conjunction()
+        chained = []
+        for goal in goals[1:]:
+            con = con & goal
+            chained.append(con)
+        self.assertFalse(any('goals' in vars(link) for link in chained))
+        self.assertEqual(con.handles, goals)
+        self.assertFalse('goals' in vars(chained[-2]))
+        self.assertEqual(chained[-2].handles, goals[:-1])
+        left = goals[0] & goals[1]
+        right = goals[2] & goals[3]
+        both = left & right
+        self.assertEqual(both.handles, goals[:4])
+        self.assertIs(both.goals[1][1], right.goals)
+        self.assertEqual(left.handles, goals[:2])